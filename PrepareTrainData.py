@@ -7,19 +7,56 @@ LastEditTime: 2020-09-16 16:46:14
 '''
 import os
 import random
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
 
-import cv2
 import matplotlib.pyplot as plt
 import numpy as np
+from scipy.spatial import cKDTree
 from tqdm import tqdm
 
+from datasetCache import cache_key, load_arrays, params_key, save_arrays
 from helpmethods import (calculate_ADE_FDE_numpy, dir_check,
                          predict_linear_for_person)
-from sceneFeature import TrajectoryMapManager
+from sceneFeature import PatchCache, TrajectoryMapManager, create_trajectory_map
 
 USE_SEED = True
 SEED = 10
 
+DATASET_DIR = [
+    './data/eth/univ',
+    './data/eth/hotel',
+    './data/ucy/zara/zara01',
+    './data/ucy/zara/zara02',
+    './data/ucy/univ/students001',
+    './data/ucy/zara/zara03',
+    './data/ucy/univ/students003',
+    './data/ucy/univ/uni_examples',
+]
+
+DATASET_XY_ORDER = [
+    [3, 2],
+    [2, 3],
+    [3, 2],
+    [3, 2],
+    [2, 3],
+    [3, 2],
+    [2, 3],
+    [2, 3],
+]
+
+# DATASET_DIR = [         # toy exp
+#     './data/toy/half_circle',
+#     './data/toy/line_circle',
+#     './data/toy',
+# ]
+
+# DATASET_XY_ORDER = [    # toy exp
+#     [2, 3],
+#     [2, 3],
+#     [2, 3],
+# ]
+
 
 def prepare_rotate_matrix(min_angel=1, save_path='./rotate_matrix.npy', load=False):
     need_to_re_calculate = True
@@ -46,11 +83,250 @@ def prepare_rotate_matrix(min_angel=1, save_path='./rotate_matrix.npy', load=Fal
 rotate_matrix = prepare_rotate_matrix(min_angel=1, load=True)
 
 
+def split_by_column(data, column):
+    """
+    Group rows of `data` by the value in `column` using one stable argsort.
+    Rows in each group keep their original order.
+    returns: `keys` (sorted unique values), `groups` (list of row blocks)
+    """
+    order = np.argsort(data[:, column], kind='stable')
+    data_sorted = data[order]
+    keys, group_start = np.unique(data_sorted[:, column], return_index=True)
+    groups = np.split(data_sorted, group_start[1:])
+    return keys, groups
+
+
+def split_trajectory_data(data, order):
+    """
+    Split trajectory records (each row is `[frame, person, *position]`) by frame and by person.
+    `order`: column index of x and y
+    returns: `person_data`, `frame_data`
+    """
+    # 加载数据（使用帧排序）
+    frame_data = {}
+    frame_list, frame_groups = split_by_column(data, 0)
+    for frame, group in zip(frame_list, frame_groups):
+        frame_data[str(frame)] = group[:, [1, order[0], order[1]]]
+
+    # 加载数据（使用行人编号排序）
+    person_data = {}
+    person_list, person_groups = split_by_column(data, 1)
+    for person, group in zip(person_list, person_groups):
+        person_data[str(person)] = group[:, [0, order[0], order[1]]]
+
+    return person_data, frame_data
+
+
+def flatten_person_data(person_data):
+    """
+    Concatenate `person_data` into flat arrays.
+    returns: `frames`, `persons`, `positions` (shape = [point_number, 2])
+    """
+    person_list = [float(person) for person in person_data]
+    person_traj = [person_data[person] for person in person_data]
+    all_data = np.concatenate(person_traj, axis=0)
+    persons = np.repeat(person_list, [len(traj) for traj in person_traj])
+    return all_data[:, 0], persons, all_data[:, 1:]
+
+
+def create_trajectory_store(person_data):
+    """
+    Create a ragged `TrajectoryStore` from `person_data` without the dense `video_matrix`.
+    """
+    frames, persons, positions = flatten_person_data(person_data)
+    frame_list, frame_index = np.unique(frames, return_inverse=True)
+    person_list, person_index = np.unique(persons, return_inverse=True)
+    frame_index = frame_index.reshape([-1])
+    person_index = person_index.reshape([-1])
+
+    # sort points by person, then by frame; keep the last record of repeated points
+    order = np.lexsort((frame_index, person_index))
+    key = person_index[order] * len(frame_list) + frame_index[order]
+    order = order[np.append(key[1:] != key[:-1], True)]
+
+    person_offsets = np.zeros(len(person_list) + 1, dtype=np.int64)
+    person_offsets[1:] = np.cumsum(np.bincount(person_index[order], minlength=len(person_list)))
+
+    # index of pedestrians that appear in each frame
+    order_frame = order[np.lexsort((person_index[order], frame_index[order]))]
+    neighbor_offsets = np.zeros(len(frame_list) + 1, dtype=np.int64)
+    neighbor_offsets[1:] = np.cumsum(np.bincount(frame_index[order_frame], minlength=len(frame_list)))
+
+    return TrajectoryStore(
+        person_offsets=person_offsets,
+        positions=positions[order],
+        frame_index=frame_index[order],
+        frame_list=frame_list,
+        neighbor_offsets=neighbor_offsets,
+        neighbor_index=person_index[order_frame],
+    )
+
+
+def normalize_windows(traj):
+    """
+    Vectorized `Agent_Part.agent_normalization` on windows, shape = [N, total_frames, 2].
+    returns: normalized windows, and `offset` (shape = [N, 2]) so that `traj = normalized + offset`
+    """
+    move = np.linalg.norm(traj[:, 0] - traj[:, 7], axis=-1) >= 0.2
+    offset = np.where(move.reshape([-1, 1]), traj[:, 7], 0.0)
+    return traj - offset[:, np.newaxis], offset
+
+
+def rotate_windows(traj, angles):
+    """
+    Rotate windows around their first point, same as `Agent_Part` with `rotate=angles`.
+    `angles`: an angle (in degree) or angles of each window, shape = [N]
+    """
+    return traj[:, :1] + np.matmul(traj - traj[:, :1], rotate_matrix[angles])
+
+
+class RaggedList():
+    """
+    A read-only list of integer arrays, saved as `offsets` and flat `values` (CSR).
+    Item `i` is `values[offsets[i]:offsets[i+1]]`.
+    """
+    def __init__(self, offsets, values):
+        self.offsets = offsets
+        self.values = values
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        return self.values[self.offsets[index]:self.offsets[index+1]]
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+
+def ragged_from_rows(rows, values, row_number):
+    """
+    Create a `RaggedList` from pairs `(rows[i], values[i])`, keeping the order of values in each row.
+    """
+    order = np.argsort(rows, kind='stable')
+    offsets = np.zeros(row_number + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(np.bincount(rows, minlength=row_number))
+    return RaggedList(offsets, values[order])
+
+
+class FrameSpatialIndex():
+    """
+    k-d tree over the positions of all agents in one frame,
+    answers "neighbors within `radius` meters" and "`k` nearest neighbors" queries in bulk.
+    """
+    def __init__(self, agent_index, positions):
+        self.agent_index = np.asarray(agent_index, dtype=np.int64)
+        self.positions = np.asarray(positions, dtype=np.float64).reshape([-1, 2])
+        self.tree = cKDTree(self.positions)
+
+    def query(self, positions, radius=0, k=0, exclude=None):
+        """
+        Neighbors of each point in `positions` (shape = [N, 2]).
+        `radius`: only agents within `radius` meters, 0 for no limit
+        `k`: only the nearest `k` agents, 0 for no limit
+        `exclude`: agent of each query (shape = [N]), which is not a neighbor of itself
+        returns: a `RaggedList` of agent indexes, sorted by agent index in each row
+        """
+        positions = np.asarray(positions, dtype=np.float64).reshape([-1, 2])
+        number = len(positions)
+        if exclude is None:
+            exclude = -np.ones(number, dtype=np.int64)
+
+        if k > 0:
+            k_query = np.minimum(k + 1, len(self.agent_index))
+            _, index = self.tree.query(
+                positions, 
+                k=k_query, 
+                distance_upper_bound=radius if radius > 0 else np.inf,
+            )
+            index = index.reshape([number, k_query])
+            valid = index < len(self.agent_index)
+            agents = self.agent_index[np.where(valid, index, 0)]
+            valid = valid & np.not_equal(agents, np.reshape(exclude, [-1, 1]))
+            valid = valid & (np.cumsum(valid, axis=1) <= k)
+            rows, cols = np.nonzero(valid)
+            agents = agents[rows, cols]
+
+        else:
+            if radius <= 0:
+                radius = np.inf
+            index_list = self.tree.query_ball_point(positions, r=radius)
+            rows = np.repeat(np.arange(number), [len(index) for index in index_list])
+            agents = self.agent_index[np.concatenate([np.asarray(index, dtype=np.int64) for index in index_list] + [np.zeros([0], dtype=np.int64)])]
+            valid = np.not_equal(agents, np.asarray(exclude)[rows])
+            rows, agents = rows[valid], agents[valid]
+
+        order = np.lexsort([agents, rows])
+        return ragged_from_rows(rows[order], agents[order], number)
+
+
+class TrajectoryStore():
+    """
+    Ragged (CSR-style) trajectories of all pedestrians in one dataset.
+    Points of person `i` are `[person_offsets[i], person_offsets[i+1])`, sorted by frame.
+
+    `positions`: shape = [point_number, 2]
+    `frame_index`: shape = [point_number], index of each point in `frame_list`
+    `frame_list`: sorted raw frame numbers
+    `video_neighbor_list`: pedestrians that appear in each frame (`RaggedList`)
+    """
+    def __init__(self, person_offsets, positions, frame_index, frame_list, neighbor_offsets, neighbor_index):
+        self.person_offsets = person_offsets
+        self.positions = positions
+        self.frame_index = frame_index
+        self.frame_list = frame_list
+        self.video_neighbor_list = RaggedList(neighbor_offsets, neighbor_index)
+
+        self.frame_number = len(frame_list)
+        self.person_number = len(person_offsets) - 1
+
+    def to_arrays(self):
+        return dict(
+            person_offsets=self.person_offsets,
+            positions=self.positions,
+            frame_index=self.frame_index,
+            frame_list=self.frame_list,
+            neighbor_offsets=self.video_neighbor_list.offsets,
+            neighbor_index=self.video_neighbor_list.values,
+        )
+
+    def get_span(self, person, init_position):
+        """
+        Get trajectory of `person` between its first and last frame.
+        Frames where the person is missing are filled with `init_position`.
+        returns: `start_frame`, `end_frame`, `traj`
+        """
+        start = self.person_offsets[person]
+        end = self.person_offsets[person+1]
+        frame_index = self.frame_index[start:end]
+        start_frame = frame_index[0]
+        end_frame = frame_index[-1] + 1     # 取不到
+
+        if end_frame - start_frame == end - start:
+            traj = self.positions[start:end]
+        else:
+            traj = init_position * np.ones([end_frame - start_frame, 2])
+            traj[frame_index - start_frame] = self.positions[start:end]
+        return start_frame, end_frame, traj
+
+
 class DataManager():
     """
         管理所有数据集的训练与测试数据
     """
-    def __init__(self, args, save=True):
+    # args that change the sampled training and test data (`train_info`), other args only change the model or training
+    data_args = [
+        'obs_frames', 'pred_frames', 'test_set', 'train_type', 'train_base', 'train_percent', 'step',
+        'reverse', 'add_noise', 'rotate', 'normalization', 'online_augment', 'trajectory_store',
+        'init_position', 'calculate_social', 'neighbor_radius', 'neighbor_k', 'map_backend',
+    ]
+
+    def __init__(self, args, save=True, prepare_data=True):
+        """
+        `prepare_data`: sample training and test data of `args.test_set` (`self.train_info`) when creating,
+            set `False` to sample data of several folds by `sample_datasets` and `get_all_train_info` later
+        """
         self.args = args
         self.obs_frames = args.obs_frames
         self.pred_frames = args.pred_frames
@@ -64,176 +340,238 @@ class DataManager():
         self.log_dir = dir_check(args.log_dir)
         self.save_file_name = args.model_name + '_{}.npy'
         self.save_path = os.path.join(self.log_dir, self.save_file_name)
-        self.train_info = self.get_train_and_test_agents()
+        self.patch_cache = PatchCache(self.args.patch_cache) if self.args.patch_cache > 0 else None
+        dir_check('./dataset_npz/')
+        self.train_info = self.get_train_and_test_agents() if prepare_data else None
+        if self.patch_cache is not None:
+            print(self.patch_cache)
         
     def get_train_and_test_agents(self):
-        dir_check('./dataset_npz/')
-        self.npy_file_base_path = './dataset_npz/{}/data.npz'
+        sample_time = 1
 
         if self.args.train_type == 'one':
-            train_list = [self.args.test_set]
-            test_list = [self.args.test_set]
-        
-        elif self.args.train_type == 'all':
-            test_list = [self.args.test_set]
-            train_list = [i for i in range(8) if not i == self.args.test_set]
-            # train_list = [i for i in range(3) if not i == self.args.test_set]   # toy exp
-        
-        data_managers_train = []
-        for dataset in train_list:
-            data_managers_train.append(self.get_agents_from_dataset(dataset)) 
+            data_manager = self.get_agents_from_dataset(self.args.test_set)
+            sample_number_original = data_manager.person_number
 
-        data_managers_test = []
-        for dataset in test_list:
-            data_managers_test.append(self.get_agents_from_dataset(dataset)) 
-
-        sample_number_original = 0
-        sample_time = 1
-        for dm in data_managers_train:
-            sample_number_original += dm.person_number
-            
-        if self.args.train_type == 'one':
             index = set([i for i in range(sample_number_original)])
             if USE_SEED:
                 random.seed(SEED)
             train_index = random.sample(index, int(sample_number_original * self.args.train_percent))
             test_index = list(index - set(train_index))
             
-            test_agents = self.sample_data(data_managers_train[0], test_index)
-            train_agents = self.sample_data(data_managers_train[0], train_index)
-            if self.args.reverse:
-                train_agents += self.sample_data(data_managers_train[0], train_index, reverse=True, desc='Preparing reverse data')
+            test_agents = self.sample_data(data_manager, test_index)
+            samples_list = [self.sample_windows(data_manager, train_index, dataset=self.args.test_set)]
+            if self.args.reverse and not self.args.online_augment:
+                samples_list.append(self.sample_windows(data_manager, train_index, dataset=self.args.test_set, reverse=True))
                 sample_time += 1
 
-            if self.args.add_noise:                
+            if self.args.add_noise and not self.args.online_augment:
                 for repeat in tqdm(range(self.args.add_noise), desc='Prepare noise data...'):
-                    train_agents += self.sample_data(data_managers_train[0], train_index, add_noise=True, use_time_bar=False)
+                    samples_list.append(self.sample_windows(data_manager, train_index, dataset=self.args.test_set, add_noise=True))
                     sample_time += 1
+
+            train_samples = concat_windows(samples_list)
         
         elif self.args.train_type == 'all':
-            train_agents = []
-            trajmaps = []
-            if len(self.args.train_percent) == 1:
-                train_percent = self.args.train_percent * np.ones([len(train_list)])
-            else:
-                train_percent = [self.args.train_percent[index] for index in train_list]
-                
-            for index, dm in enumerate(data_managers_train):
-                agents, trajmap = self.sample_data(
-                    dm, 
-                    person_index='auto', 
-                    random_sample=train_percent[index], 
-                    return_trajmap=True
-                )
-                train_agents += agents
-                trajmaps.append(trajmap)
-
-            if self.args.reverse:
-                for index, dm in enumerate(data_managers_train):
-                    train_agents += self.sample_data(
-                        dm, 
-                        person_index='auto', 
-                        random_sample=train_percent[index], 
-                        reverse=True, 
-                        use_time_bar=False
-                    )
-                sample_time += 1
+            return self.get_all_train_info(self.args.test_set)
+        
+        return self.create_train_info(train_samples, test_agents, sample_time)
 
-            if self.args.rotate:
-                for angel in tqdm(range(360//self.args.rotate, 360, 360//self.args.rotate), desc='Prepare rotate data...'):
-                    sample_time += 1
-                    for index, [dm, gm] in enumerate(zip(data_managers_train, trajmaps)):
-                        train_agents += self.sample_data(
-                            dm, 
-                            person_index='auto', 
-                            random_sample=train_percent[index], 
-                            rotate=angel, 
-                            use_time_bar=False, 
-                            given_trajmap=gm
-                        )
-                
-            test_agents, test_trajmap = self.sample_data(
-                data_managers_test[0], 
-                person_index='auto', 
-                return_trajmap=True, 
-                random_sample=False,
-            )
+    def get_train_list(self, test_set):
+        """
+        Training datasets (all datasets except `test_set`) and their `train_percent` when `train_type == 'all'`.
+        """
+        train_list = [i for i in range(8) if not i == test_set]
+        # train_list = [i for i in range(3) if not i == test_set]   # toy exp
+
+        if len(self.args.train_percent) == 1:
+            train_percent = self.args.train_percent * np.ones([len(train_list)])
+        else:
+            train_percent = [self.args.train_percent[index] for index in train_list]
+        return train_list, train_percent
+
+    def load_train_samples(self, test_set):
+        """
+        Sampled training data of the fold `test_set` from the cache (`args.sample_cache`), `None` if not cached.
+        """
+        if not self.args.sample_cache:
+            return None
+
+        samples_key = self.get_samples_key(*self.get_train_list(test_set))
+        cache_path = os.path.join('./dataset_npz/', samples_key)
+        train_arrays = load_arrays(cache_path, WindowSamples.names, samples_key)
+        if not train_arrays:
+            return None
+
+        print('Load sampled training data from "{}"...'.format(cache_path))
+        return WindowSamples(**train_arrays)
+
+    def sample_datasets(self, train_datasets:dict, test_sets:list):
+        """
+        Sample training data of `train_datasets` (`{dataset: train_percent}`) and test agents of `test_sets`,
+        so that each dataset is loaded and sampled only once for all folds.
+        Datasets are sampled in `args.prep_workers` processes if `prep_workers > 0`.
+        returns: `{dataset: (samples, reverse_samples, rotate_samples)}` (see `sample_train_dataset`), `{test_set: test_agents}`
+        """
+        train_list = list(train_datasets)
+        if self.args.prep_workers > 0:
+            # 每个数据集在单独的进程中加载与取样
+            with ProcessPoolExecutor(max_workers=self.args.prep_workers, mp_context=get_context('spawn')) as executor:
+                test_jobs = [executor.submit(self.sample_test_dataset, test_set, False) for test_set in test_sets]
+                dataset_samples = list(executor.map(self.sample_train_dataset, train_list, [train_datasets[dataset] for dataset in train_list]))
+                test_agents = [job.result() for job in test_jobs]
+        else:
+            dataset_samples = [self.sample_train_dataset(dataset, train_datasets[dataset]) for dataset in train_list]
+            test_agents = [self.sample_test_dataset(test_set) for test_set in test_sets]
         
+        return dict(zip(train_list, dataset_samples)), dict(zip(test_sets, test_agents))
+
+    def get_all_train_info(self, test_set, dataset_samples=None, test_agents=None):
+        """
+        Training and test data of the fold `test_set` when `train_type == 'all'`.
+        `dataset_samples`, `test_agents`: data sampled before by `sample_datasets`, datasets are sampled here if `None`
+        """
+        sample_time = 1
+        if self.args.reverse and not self.args.online_augment:
+            sample_time += 1
+        if not self.args.online_augment:
+            sample_time += len(self.get_rotate_angles())
+
+        train_list, train_percent = self.get_train_list(test_set)
+        train_samples = self.load_train_samples(test_set)  # 使用缓存的训练数据
+        if train_samples is None and (dataset_samples is None or not all(dataset in dataset_samples for dataset in train_list)):
+            dataset_samples, test_agents = self.sample_datasets(dict(zip(train_list, train_percent)), [test_set])
+
+        if train_samples is None:
+            # same order as sampling all datasets serially: original, reverse, then each rotate angle
+            samples_list = [dataset_samples[dataset][0] for dataset in train_list]
+            if self.args.reverse and not self.args.online_augment:
+                samples_list += [dataset_samples[dataset][1] for dataset in train_list]
+
+            for angel_index in range(len(dataset_samples[train_list[0]][2])):
+                samples_list += [dataset_samples[dataset][2][angel_index] for dataset in train_list]
+
+            train_samples = concat_windows(samples_list)
+            if self.args.sample_cache:
+                samples_key = self.get_samples_key(train_list, train_percent)
+                save_arrays(os.path.join('./dataset_npz/', samples_key), train_samples.to_arrays(), samples_key)
+
+        if test_agents is None or not test_set in test_agents:
+            test_agents = {test_set: self.sample_test_dataset(test_set)}
+        return self.create_train_info(train_samples, test_agents[test_set], sample_time)
+
+    def create_train_info(self, train_samples, test_agents, sample_time):
         train_info = dict()
-        train_info['train_data'] = train_agents
+        train_info['train_data'] = train_samples
         train_info['test_data'] = test_agents
-        train_info['train_number'] = len(train_agents)
+        train_info['train_number'] = len(train_samples)
         train_info['sample_time'] = sample_time  
+        train_info['augmentation'] = None
+        if self.args.online_augment:
+            train_info['augmentation'] = WindowAugmentation(
+                train_samples, 
+                self.get_augment_variants(), 
+                self.obs_frames, 
+                normalization=self.args.normalization,
+                map_backend=self.args.map_backend,
+            )
 
         return train_info
 
+    def get_samples_key(self, train_list, train_percent):
+        """
+        Cache key of sampled training data, i.e. hash of all source datasets and sampling args.
+        """
+        return params_key(
+            datasets=[self.get_dataset_key(dataset) for dataset in train_list],
+            train_percent=[float(percent) for percent in train_percent],
+            obs_frames=self.obs_frames,
+            pred_frames=self.pred_frames,
+            step=self.step,
+            reverse=self.args.reverse,
+            rotate=self.args.rotate,
+            normalization=self.args.normalization,
+            online_augment=self.args.online_augment,
+        )
+
+    def get_rotate_angles(self):
+        if not self.args.rotate:
+            return []
+        return [angel for angel in range(360//self.args.rotate, 360, 360//self.args.rotate)]
+
+    def get_augment_variants(self):
+        """
+        Variants used by `WindowAugmentation`, i.e. the same copies saved when not using `online_augment`.
+        """
+        variants = [['original', 0]]
+        if self.args.reverse:
+            variants.append(['reverse', 0])
+
+        if self.args.train_type == 'one':
+            variants += [['noise', 0] for _ in range(self.args.add_noise)]
+        else:
+            variants += [['rotate', angel] for angel in self.get_rotate_angles()]
+        return variants
+
+    def sample_train_dataset(self, dataset, train_percent):
+        """
+        Load one dataset and sample all its training data (original, reverse and rotate).
+        Only original windows are sampled when using `online_augment`.
+        returns: `samples`, `reverse_samples`, `rotate_samples` (a list with one `WindowSamples` for each rotate angle)
+        """
+        dm = self.get_agents_from_dataset(dataset)
+        samples, trajmap = self.sample_windows(
+            dm, 
+            person_index='auto', 
+            dataset=dataset,
+            random_sample=train_percent, 
+            return_trajmap=True,
+        )
+
+        reverse_samples = None
+        if self.args.reverse and not self.args.online_augment:
+            reverse_samples = self.sample_windows(
+                dm, 
+                person_index='auto', 
+                dataset=dataset,
+                random_sample=train_percent, 
+                reverse=True, 
+            )
+
+        rotate_samples = []
+        if not self.args.online_augment:
+            for angel in self.get_rotate_angles():
+                rotate_samples.append(self.sample_windows(
+                    dm, 
+                    person_index='auto', 
+                    dataset=dataset,
+                    random_sample=train_percent, 
+                    rotate=angel, 
+                    given_trajmap=trajmap
+                ))
+        
+        return samples, reverse_samples, rotate_samples
+
+    def sample_test_dataset(self, dataset, use_time_bar=True):
+        dm = self.get_agents_from_dataset(dataset)
+        test_agents, test_trajmap = self.sample_data(
+            dm, 
+            person_index='auto', 
+            return_trajmap=True, 
+            random_sample=False,
+            use_time_bar=use_time_bar,
+        )
+        return test_agents
+
     def data_loader(self, dataset_index):
         """
         Read trajectory data from csv file.
         returns: `person_data`, `frame_data`
         """
-        dataset_dir = [
-            './data/eth/univ',
-            './data/eth/hotel',
-            './data/ucy/zara/zara01',
-            './data/ucy/zara/zara02',
-            './data/ucy/univ/students001',
-            './data/ucy/zara/zara03',
-            './data/ucy/univ/students003',
-            './data/ucy/univ/uni_examples',
-        ]
-
-        dataset_xy_order = [
-            [3, 2],
-            [2, 3],
-            [3, 2],
-            [3, 2],
-            [2, 3],
-            [3, 2],
-            [2, 3],
-            [2, 3],
-        ]
-
-        # dataset_dir = [         # toy exp
-        #     './data/toy/half_circle',
-        #     './data/toy/line_circle',
-        #     './data/toy',
-        # ]
-
-        # dataset_xy_order = [    # toy exp
-        #     [2, 3],
-        #     [2, 3],
-        #     [2, 3],
-        # ]
-
-        dataset_dir_current = dataset_dir[dataset_index]
-        order = dataset_xy_order[dataset_index]
-
-        csv_file_path = os.path.join(dataset_dir_current, 'true_pos_.csv')
+        order = DATASET_XY_ORDER[dataset_index]
+        csv_file_path = os.path.join(DATASET_DIR[dataset_index], 'true_pos_.csv')
         data = np.genfromtxt(csv_file_path, delimiter=',').T 
-
-        # 加载数据（使用帧排序）
-        frame_data = {}
-        frame_list = set(data.T[0])
-        for frame in frame_list:
-            index_current = np.where(data.T[0] == frame)[0]
-            frame_data[str(frame)] = np.column_stack([
-                data[index_current, 1],
-                data[index_current, order[0]],
-                data[index_current, order[1]],
-            ])
-
-        # 加载数据（使用行人编号排序）
-        person_data = {}
-        person_list = set(data.T[1])
-        for person in person_list:
-            index_current = np.where(data.T[1] == person)[0]
-            person_data[str(person)] = np.column_stack([
-                data[index_current, 0],
-                data[index_current, order[0]],
-                data[index_current, order[1]],
-            ])
-        
+        person_data, frame_data = split_trajectory_data(data, order)
         print('Load dataset from csv file done.')
         return person_data, frame_data
 
@@ -242,99 +580,216 @@ class DataManager():
         使用数据计算social关系，并组织为`Agent_part`类或`Frame`类
             return: agents, original_sample_number
         """
-        base_path = dir_check(os.path.join('./dataset_npz/', '{}'.format(dataset)))
-        npy_path = self.npy_file_base_path.format(dataset)
-
-        if os.path.exists(npy_path):
-            # 从保存的npy数据集文件中读
-            video_neighbor_list, video_matrix, frame_list = self.load_video_matrix(dataset)
-        else:
-            # 新建npy数据集文件
-            person_data, frame_data = self.data_loader(dataset)
-            video_neighbor_list, video_matrix, frame_list = self.create_video_matrix(
-                person_data, 
-                frame_data, 
-                save_path=npy_path
-            )
+        video_neighbor_list, video_matrix, frame_list = self.load_dataset(dataset)
 
         if self.args.train_base == 'agent':
             data_manager = self.get_agents(video_neighbor_list, video_matrix, frame_list)
             print('\nPrepare agent data in dataset {} done.'.format(dataset))
             return data_manager
+
+    def get_dataset_key(self, dataset):
+        """
+        Cache key of one dataset, i.e. hash of its csv file and preprocessing args.
+        """
+        return cache_key(
+            os.path.join(DATASET_DIR[dataset], 'true_pos_.csv'),
+            order=DATASET_XY_ORDER[dataset],
+            init_position=self.args.init_position,
+            trajectory_store=self.args.trajectory_store,
+        )
         
-    def load_video_matrix(self, dataset):
+    def load_dataset(self, dataset):
         """
-        从保存的文件中读取social matrix和social neighbor
+        Load trajectories of one dataset from `./dataset_npz/`, or create and save them from the csv file.
+        Cache entries are named by `get_dataset_key`, so they are rebuilt once the csv file or args change.
+        Loaded arrays are read-only memory maps.
+        returns: `video_neighbor_list`, `video_matrix` (`TrajectoryStore` when `trajectory_store == 'ragged'`), `frame_list`
         """
-        print('Load data from "{}"...'.format(self.npy_file_base_path.format(dataset)))
-        all_data = np.load(self.npy_file_base_path.format(dataset), allow_pickle=True)
-        video_neighbor_list = all_data['video_neighbor_list']
-        video_matrix = all_data['video_matrix']
-        frame_list = all_data['frame_list']
-        return video_neighbor_list, video_matrix, frame_list
+        key = self.get_dataset_key(dataset)
+        cache_path = os.path.join('./dataset_npz/', key)
+        ragged = (self.args.trajectory_store == 'ragged')
+        if ragged:
+            names = ['person_offsets', 'positions', 'frame_index', 'frame_list', 'neighbor_offsets', 'neighbor_index']
+        else:
+            names = ['video_matrix', 'frame_list', 'neighbor_offsets', 'neighbor_index']
+
+        arrays = load_arrays(cache_path, names, key)
+        if arrays and not (len(arrays['neighbor_offsets']) == len(arrays['frame_list']) + 1
+                           and arrays['neighbor_offsets'][-1] == len(arrays['neighbor_index'])):
+            arrays = None
+
+        if arrays:
+            print('Load data from "{}"...'.format(cache_path))
+        else:
+            person_data, frame_data = self.data_loader(dataset)
+            if ragged:
+                arrays = create_trajectory_store(person_data).to_arrays()
+            else:
+                video_neighbor_list, video_matrix, frame_list = self.create_video_matrix(person_data, frame_data)
+                arrays = dict(
+                    video_matrix=video_matrix,
+                    frame_list=frame_list,
+                    neighbor_offsets=video_neighbor_list.offsets,
+                    neighbor_index=video_neighbor_list.values,
+                )
+            save_arrays(cache_path, arrays, key)
 
-    def create_video_matrix(self, person_data, frame_data, save_path='null'):
+        if ragged:
+            store = TrajectoryStore(**arrays)
+            return store.video_neighbor_list, store, store.frame_list
+
+        video_neighbor_list = RaggedList(arrays['neighbor_offsets'], arrays['neighbor_index'])
+        return video_neighbor_list, arrays['video_matrix'], arrays['frame_list']
+
+    def create_video_matrix(self, person_data, frame_data):
         """
         计算social neighbor
         `video_matrix`: shape = [frame_number, person_number, 2]
+        `frame_list`: sorted raw frame numbers (float) of each row in `video_matrix`
+        `video_neighbor_list`: pedestrians that appear in each frame (`RaggedList`)
         """
-        person_list = np.sort(np.stack([float(person) for person in person_data])).astype(np.str)
-        frame_list = np.sort(np.stack([float(frame) for frame in frame_data])).astype(np.str)
+        frames, persons, positions = flatten_person_data(person_data)
+        frame_list, frame_index_all = np.unique(frames, return_inverse=True)
+        person_list = np.unique(persons)
+        person_index_all = np.searchsorted(person_list, persons)
 
         person_number = len(person_list)
         frame_number = len(frame_list)
 
         video_matrix = self.args.init_position * np.ones([frame_number, person_number, 2])
-        for person in person_data:
-            person_index = np.where(person_list == person)[0][0]
-            frame_list_current = (person_data[person]).T[0].astype(np.str)
-            frame_index_current = np.reshape(np.stack([np.where(frame_current == frame_list) for frame_current in frame_list_current]), [-1])
-            traj_current = person_data[person][:, 1:]
-            video_matrix[frame_index_current, person_index, :] = traj_current
-
-        video_neighbor_list = []
-        for frame_index, data in enumerate(tqdm(video_matrix, desc='Calculate social matrix...')):
-            person_appear = np.where(np.not_equal(data.T[0], self.args.init_position))[0]
-            video_neighbor_list.append(person_appear)
-
-        if not save_path == 'null':
-            np.savez(
-                save_path, 
-                video_neighbor_list=video_neighbor_list,
-                video_matrix=video_matrix,
-                frame_list=frame_list,
-            )
+        video_matrix[frame_index_all, person_index_all, :] = positions
+
+        # 每一帧中出现的行人
+        frame_appear, person_appear = np.nonzero(np.not_equal(video_matrix[:, :, 0], self.args.init_position))
+        neighbor_offsets = np.zeros(frame_number + 1, dtype=np.int64)
+        neighbor_offsets[1:] = np.cumsum(np.bincount(frame_appear, minlength=frame_number))
+        video_neighbor_list = RaggedList(neighbor_offsets, person_appear)
         return video_neighbor_list, video_matrix, frame_list
 
+    def get_person_index(self, data_manager, random_sample=False, sample_start=0.0):
+        """
+        `random_sample`: 为0到1的正数时表示随机取样百分比，为-1到0的负数时表示按照数据集时间顺序百分比取样的终点，此时0～1正数`sample_start`表示起点
+        """
+        if random_sample > 0 and random_sample < 1:
+            if USE_SEED:
+                random.seed(SEED)
+            person_index = random.sample(
+                [i for i in range(data_manager.person_number)], 
+                int(data_manager.person_number * random_sample),
+            )
+        elif random_sample == 0 or random_sample >= 1 or random_sample < -1:
+            person_index = range(data_manager.person_number)
+
+        elif random_sample < 0 and random_sample >= -1:
+            person_index = [i for i in range(
+                (data_manager.person_number * np.abs(sample_start)).astype(int),   # start index
+                (data_manager.person_number * np.abs(random_sample)).astype(int),   # end index
+            )]
+        return person_index
+
+    def sample_windows(self, data_manager, person_index, dataset=-1, add_noise=False, reverse=False, rotate=False, random_sample=False, sample_start=0.0, given_trajmap=False, return_trajmap=False):
+        """
+        Sample data from data_manager as `WindowSamples`, without creating an `Agent_Part` for each window.
+        Windows and trajectory maps are the same as `sample_data` with the same args.
+        return: `WindowSamples`
+        """
+        if person_index == 'auto':
+            person_index = self.get_person_index(data_manager, random_sample, sample_start)
+
+        traj_windows = []
+        persons = []
+        start_frames = []
+        for person in person_index:
+            agent = data_manager.agent_data[person]
+            window_number = (agent.end_frame - agent.start_frame - self.total_frames) // self.step + 1
+            if window_number <= 0:
+                continue
+
+            # all windows of this agent, shape = [window_number, total_frames, 2] (a view of `traj`)
+            traj = np.asarray(agent.get_traj(agent.start_frame, agent.end_frame))
+            traj_windows.append(np.lib.stride_tricks.as_strided(
+                traj,
+                shape=[window_number, self.total_frames, 2],
+                strides=[self.step * traj.strides[0], traj.strides[0], traj.strides[1]],
+                writeable=False,
+            ))
+            persons.append(person * np.ones(window_number, dtype=np.int64))
+            start_frames.append(agent.start_frame + self.step * np.arange(window_number, dtype=np.int64))
+
+        if len(traj_windows):
+            traj_original = np.concatenate(traj_windows, axis=0)
+            persons = np.concatenate(persons)
+            start_frames = np.concatenate(start_frames)
+        else:
+            traj_original = np.zeros([0, self.total_frames, 2])
+            persons = np.zeros([0], dtype=np.int64)
+            start_frames = np.zeros([0], dtype=np.int64)
+
+        traj = traj_original
+        if add_noise:
+            traj = traj + np.random.normal(0, 0.1, size=traj.shape)
+        elif reverse:
+            traj = traj[:, ::-1]
+        elif rotate:    # rotate 为旋转角度
+            traj = rotate_windows(traj, rotate)
+
+        offset = np.zeros([len(traj), 2])
+        if self.args.normalization:
+            traj, offset = normalize_windows(traj)
+
+        obs = traj[:, :self.obs_frames]
+        if not given_trajmap:
+            trajmap = create_trajectory_map(obs, self.args.map_backend)
+        else:
+            trajmap = given_trajmap
+
+        if not rotate:
+            center_pos = trajmap.real2map(obs[:, -1])
+        else:
+            center_pos = trajmap.real2map(traj_original[:, self.obs_frames])
+
+        maps = trajmap.extract_patches(
+            center_pos, 
+            angles=(rotate if rotate else 0) * np.ones(len(traj)), 
+            flips=bool(reverse) * np.ones(len(traj), dtype=bool),
+            threads=self.args.map_threads,
+            cache=self.patch_cache,
+        ).astype(np.float32)
+
+        samples = WindowSamples(
+            obs=obs.astype(np.float32),
+            gt=traj[:, self.obs_frames:].astype(np.float32),
+            maps=maps,
+            offset=offset.astype(np.float32),
+            person=persons,
+            start_frame=start_frames,
+            obs_frame=start_frames + self.obs_frames,
+            end_frame=start_frames + self.total_frames,
+            dataset=dataset * np.ones(len(traj), dtype=np.int64),
+            rotate=(rotate if rotate else 0) * np.ones(len(traj), dtype=np.int64),
+            reverse=np.ones(len(traj), dtype=bool) & bool(reverse and not add_noise),
+        )
+
+        if return_trajmap:
+            return samples, trajmap
+        return samples
+
     def sample_data(self, data_manager, person_index, add_noise=False, reverse=False, rotate=False, desc='Calculate agent data', use_time_bar=True, random_sample=False, sample_start=0.0, given_trajmap=False, return_trajmap=False):
         """
-        Sample training data from data_manager.
+        Sample data from data_manager.
         `random_sample`: 为0到1的正数时表示随机取样百分比，为-1到0的负数时表示按照数据集时间顺序百分比取样的终点，此时0～1正数`sample_start`表示起点
         return: a list of Agent_Part
         """
         agents = []
         if person_index == 'auto':
-            if random_sample > 0 and random_sample < 1:
-                if USE_SEED:
-                    random.seed(SEED)
-                person_index = random.sample(
-                    [i for i in range(data_manager.person_number)], 
-                    int(data_manager.person_number * random_sample),
-                )
-            elif random_sample == 0 or random_sample >= 1 or random_sample < -1:
-                person_index = range(data_manager.person_number)
-
-            elif random_sample < 0 and random_sample >= -1:
-                person_index = [i for i in range(
-                    (data_manager.person_number * np.abs(sample_start)).astype(int),   # start index
-                    (data_manager.person_number * np.abs(random_sample)).astype(int),   # end index
-                )]
+            person_index = self.get_person_index(data_manager, random_sample, sample_start)
 
         if use_time_bar:
             itera = tqdm(person_index, desc=desc)
         else:
             itera = person_index
 
+        windows = []    # [person, start frame] of each window
         for person in itera:
             agent_current = data_manager.agent_data[person]
             start_frame = agent_current.start_frame
@@ -343,25 +798,41 @@ class DataManager():
             for frame_point in range(start_frame, end_frame, self.args.step):
                 if frame_point + self.total_frames > end_frame:
                     break
-                
-                # type: Agent_Part
-                sample_agent = data_manager.get_trajectory(
-                    person,
-                    frame_point, 
-                    frame_point+self.obs_frames, 
-                    frame_point+self.total_frames,
-                    calculate_social=self.args.calculate_social,
-                    normalization=self.args.normalization,
-                    add_noise=add_noise,
-                    reverse=reverse,
-                    rotate=rotate,
-                )     
-                agents.append(sample_agent)
+                windows.append([person, frame_point])
+
+        # neighbors of all windows are gathered in batches, virtual agents do not keep neighbors
+        windows = np.array(windows, dtype=np.int64).reshape([-1, 2])
+        neighbor_list = [None for _ in range(len(windows))]
+        if not (add_noise or reverse or rotate):
+            batch_size = 4096
+            for start in range(0, len(windows), batch_size):
+                neighbor_traj, mask, _ = data_manager.get_neighbor_batch(
+                    windows[start:start+batch_size, 0],
+                    windows[start:start+batch_size, 1] + self.obs_frames,
+                    self.obs_frames,
+                )
+                for index in range(len(mask)):
+                    neighbor_list[start+index] = neighbor_traj[index][mask[index]]
+
+        for (person, frame_point), neighbor_traj in zip(windows, neighbor_list):
+            # type: Agent_Part
+            sample_agent = data_manager.get_trajectory(
+                person,
+                frame_point, 
+                frame_point+self.obs_frames, 
+                frame_point+self.total_frames,
+                calculate_social=self.args.calculate_social,
+                normalization=self.args.normalization,
+                add_noise=add_noise,
+                reverse=reverse,
+                rotate=rotate,
+                neighbor_traj=neighbor_traj,
+            )     
+            agents.append(sample_agent)
 
         if not given_trajmap:
-            traj_trajmap = TrajectoryMapManager(agents)
-            for index in range(len(agents)):
-                agents[index].write_traj_map(traj_trajmap)  
+            traj_trajmap = create_trajectory_map(agents, self.args.map_backend)
+            traj_trajmap.write_traj_maps(agents, threads=self.args.map_threads, cache=self.patch_cache)
 
             if return_trajmap:
                 return agents, traj_trajmap
@@ -369,8 +840,7 @@ class DataManager():
                 return agents
 
         else:
-            for index in range(len(agents)):
-                agents[index].write_traj_map(given_trajmap)   
+            given_trajmap.write_traj_maps(agents, threads=self.args.map_threads, cache=self.patch_cache)
             return agents
     
     def get_agents(self, video_neighbor_list, video_matrix, frame_list):
@@ -379,24 +849,195 @@ class DataManager():
             return: agents(取样后, type=`Agent_part`), original_sample_number
         """
         data_manager = DatasetManager(
-            video_neighbor_list, video_matrix, frame_list, self.args.init_position
+            video_neighbor_list, video_matrix, frame_list, self.args.init_position,
+            neighbor_radius=self.args.neighbor_radius,
+            neighbor_k=self.args.neighbor_k,
         )
         return data_manager
 
 
+class WindowSamples():
+    """
+    Sampled windows saved as a structure of arrays.
+
+    `obs`: shape = [N, obs_frames, 2]
+    `gt`: shape = [N, pred_frames, 2]
+    `maps`: trajectory map of each window, shape = [N, 32, 32]
+    `offset`: offset removed by normalization (zeros if not normalized), shape = [N, 2]
+    `person`, `start_frame`, `obs_frame`, `end_frame`, `dataset`, `rotate`, `reverse`: shape = [N]
+    """
+    names = ['obs', 'gt', 'maps', 'offset', 'person', 'start_frame', 'obs_frame', 'end_frame', 'dataset', 'rotate', 'reverse']
+
+    def __init__(self, obs, gt, maps, offset, person, start_frame, obs_frame, end_frame, dataset, rotate, reverse):
+        self.obs = obs
+        self.gt = gt
+        self.maps = maps
+        self.offset = offset
+        self.person = person
+        self.start_frame = start_frame
+        self.obs_frame = obs_frame
+        self.end_frame = end_frame
+        self.dataset = dataset
+        self.rotate = rotate
+        self.reverse = reverse
+
+    def __len__(self):
+        return len(self.gt)
+
+    def to_arrays(self):
+        return {name: getattr(self, name) for name in self.names}
+
+    def select(self, index):
+        """
+        Get windows `index` as a new `WindowSamples`.
+        """
+        return WindowSamples(**{name: getattr(self, name)[index] for name in self.names})
+
+    def get_agent(self, index, data_manager, normalization=False):
+        """
+        Get window `index` as an `Agent_Part` (with its neighbors) from its `DatasetManager`.
+        """
+        agent = data_manager.get_trajectory(
+            self.person[index],
+            self.start_frame[index],
+            self.obs_frame[index],
+            self.end_frame[index],
+            normalization=normalization,
+            reverse=bool(self.reverse[index]),
+            rotate=int(self.rotate[index]),
+        )
+        agent.traj_map = self.maps[index]
+        return agent
+
+
+def concat_windows(samples_list):
+    """
+    Concatenate a list of `WindowSamples` in order.
+    """
+    return WindowSamples(**{
+        name: np.concatenate([getattr(samples, name) for samples in samples_list], axis=0) for name in WindowSamples.names
+    })
+
+
+class WindowAugmentation():
+    """
+    Augment batches of `WindowSamples` on the fly instead of saving augmented copies of all training data.
+    Each window in a batch is given one of `variants` at random, so the training distribution is the same
+    as sampling from all saved copies, while only original windows are kept in memory.
+
+    `variants`: a list of `['original', 0]`, `['reverse', 0]`, `['noise', 0]` or `['rotate', angel]`
+    """
+    def __init__(self, samples:WindowSamples, variants:list, obs_frames, normalization=False, map_backend='dense'):
+        self.variants = variants
+        self.obs_frames = obs_frames
+        self.normalization = normalization
+        self.variant_names = np.array([name for name, _ in variants])
+        self.variant_angles = np.array([angel for _, angel in variants], dtype=np.int64)
+
+        # trajectory maps of each dataset (maps of reversed windows are created from reversed trajectories)
+        self.trajmaps = dict()
+        self.reverse_trajmaps = dict()
+        for dataset in np.unique(samples.dataset):
+            index = np.where(samples.dataset == dataset)[0]
+            self.trajmaps[dataset] = create_trajectory_map(np.asarray(samples.obs[index], dtype=np.float64), map_backend)
+
+            if 'reverse' in self.variant_names:
+                traj = self.get_traj(samples.select(index))[:, ::-1]
+                if self.normalization:
+                    traj, _ = normalize_windows(traj)
+                self.reverse_trajmaps[dataset] = create_trajectory_map(traj[:, :self.obs_frames], map_backend)
+
+    def get_traj(self, samples:WindowSamples):
+        """
+        Whole windows (before normalization), shape = [N, total_frames, 2]
+        """
+        traj = np.concatenate([samples.obs, samples.gt], axis=1).astype(np.float64)
+        return traj + np.asarray(samples.offset, dtype=np.float64)[:, np.newaxis]
+
+    def augment(self, samples:WindowSamples, index):
+        """
+        Get windows `index` of `samples` with random augmentation.
+        returns: `WindowSamples`
+        """
+        batch = samples.select(index)
+        variant = np.random.randint(len(self.variants), size=len(batch))
+        names = self.variant_names[variant]
+        angles = self.variant_angles[variant]
+        noise = names == 'noise'
+        reverse = names == 'reverse'
+        rotate = names == 'rotate'
+        if not np.any(noise | reverse | rotate):
+            return batch
+
+        traj_original = self.get_traj(batch)
+        traj = traj_original.copy()
+        traj[noise] += np.random.normal(0, 0.1, size=traj[noise].shape)
+        traj[reverse] = traj[reverse][:, ::-1]
+        traj[rotate] = rotate_windows(traj[rotate], angles[rotate])
+
+        offset = np.zeros([len(traj), 2])
+        if self.normalization:
+            traj, offset = normalize_windows(traj)
+
+        # same centers as `sample_windows`
+        centers_traj = np.where(rotate.reshape([-1, 1]), traj_original[:, self.obs_frames], traj[:, self.obs_frames-1])
+        maps = np.array(batch.maps)
+        for dataset in np.unique(batch.dataset):
+            current = batch.dataset == dataset
+            for trajmap, need_patch in [
+                [self.trajmaps.get(dataset), current & (noise | rotate)],
+                [self.reverse_trajmaps.get(dataset), current & reverse],
+            ]:
+                if np.any(need_patch):
+                    maps[need_patch] = trajmap.extract_patches(
+                        trajmap.real2map(centers_traj[need_patch]), 
+                        angles=angles[need_patch] * rotate[need_patch],
+                        flips=reverse[need_patch],
+                    )
+
+        return WindowSamples(
+            obs=traj[:, :self.obs_frames].astype(np.float32),
+            gt=traj[:, self.obs_frames:].astype(np.float32),
+            maps=maps,
+            offset=offset.astype(np.float32),
+            person=batch.person,
+            start_frame=batch.start_frame,
+            obs_frame=batch.obs_frame,
+            end_frame=batch.end_frame,
+            dataset=batch.dataset,
+            rotate=angles * rotate,
+            reverse=reverse,
+        )
+
+
 class DatasetManager():
     """
         管理一个数据集内的所有轨迹数据
     """
-    def __init__(self, video_neighbor_list, video_matrix, frame_list, init_position):
+    def __init__(self, video_neighbor_list, video_matrix, frame_list, init_position, neighbor_radius=0, neighbor_k=0):
+        """
+        `neighbor_radius`, `neighbor_k`: only use agents within `neighbor_radius` meters, or the nearest `neighbor_k` agents
+            in the last observed frame as neighbors (0 for no limit, i.e. all agents in that frame)
+        """
         self.video_neighbor_list = video_neighbor_list
         self.video_matrix = video_matrix
         self.frame_list = frame_list
         self.init_position = init_position
+        self.neighbor_radius = neighbor_radius
+        self.neighbor_k = neighbor_k
+        self.spatial_index = dict()     # 每帧行人位置的 k-d tree, {frame: FrameSpatialIndex}
         self.agent_data = self.prepare_agent_data()
+        self.person_start = np.array([agent.start_frame for agent in self.agent_data], dtype=np.int64)
+        self.person_end = np.array([agent.end_frame for agent in self.agent_data], dtype=np.int64)
+        self.frame_neighbors = dict()   # 每个观测帧所有行人的观测轨迹, {(obs_frame, obs_length): (neighbor_index, neighbor_traj)}
 
     def prepare_agent_data(self):
-        self.frame_number, self.person_number, _ = self.video_matrix.shape
+        if type(self.video_matrix) == TrajectoryStore:
+            self.frame_number = self.video_matrix.frame_number
+            self.person_number = self.video_matrix.person_number
+        else:
+            self.frame_number, self.person_number, _ = self.video_matrix.shape
+
         agent_data = []
         for person in range(self.person_number):
             agent_data.append(Agent(
@@ -408,31 +1049,187 @@ class DatasetManager():
             ))
         return agent_data
 
-    def get_trajectory(self, agent_index, start_frame, obs_frame, end_frame, calculate_social=True, normalization=False, add_noise=False, reverse=False, rotate=False):
+    def get_frame_neighbors(self, obs_frame, obs_length):
+        """
+        Observed trajectories (frames `[obs_frame-obs_length, obs_frame)`) of all agents in frame `obs_frame-1`.
+        Frames before an agent appears (or after it leaves) are filled with its first (or last) position.
+        Results are computed once for each observation frame and shared by all windows observed at that frame.
+        returns: `neighbor_index` (shape = [M]), `neighbor_traj` (read-only, shape = [M, obs_length, 2])
+        """
+        key = (int(obs_frame), int(obs_length))
+        if not key in self.frame_neighbors:
+            start_frame = obs_frame - obs_length
+            neighbor_index = np.asarray(self.video_neighbor_list[obs_frame-1], dtype=np.int64)
+            if type(self.video_matrix) == TrajectoryStore:
+                neighbor_traj = np.zeros([len(neighbor_index), obs_length, 2])
+                for index, neighbor in enumerate(neighbor_index):
+                    neighbor_traj[index] = self.agent_data[neighbor].get_traj(start_frame, obs_frame)
+            else:
+                neighbor_traj = np.transpose(np.asarray(self.video_matrix[start_frame:obs_frame, neighbor_index]), [1, 0, 2])
+
+            valid_start = np.maximum(self.person_start[neighbor_index], start_frame) - start_frame
+            valid_end = np.minimum(self.person_end[neighbor_index], obs_frame) - start_frame
+            frame_index = np.minimum(
+                np.maximum(np.arange(obs_length), valid_start[:, np.newaxis]),
+                valid_end[:, np.newaxis] - 1,
+            )
+            neighbor_traj = neighbor_traj[np.arange(len(neighbor_index))[:, np.newaxis], frame_index]
+            neighbor_traj.flags.writeable = False
+            self.frame_neighbors[key] = (neighbor_index, neighbor_traj)
+
+        return self.frame_neighbors[key]
+
+    def get_spatial_index(self, frame):
+        """
+        Spatial index over the positions of all agents in `frame`, created once for each frame.
+        """
+        if not frame in self.spatial_index:
+            agent_index = np.asarray(self.video_neighbor_list[frame], dtype=np.int64)
+            if type(self.video_matrix) == TrajectoryStore:
+                positions = np.zeros([len(agent_index), 2])
+                for index, agent in enumerate(agent_index):
+                    positions[index] = self.agent_data[agent].get_traj(frame, frame+1)[0]
+            else:
+                positions = np.asarray(self.video_matrix[frame, agent_index])
+            self.spatial_index[frame] = FrameSpatialIndex(agent_index, positions)
+        return self.spatial_index[frame]
+
+    def limit_neighbors(self, agent_index, obs_frame):
+        """
+        Neighbors of agents `agent_index` (shape = [N]) at frame `obs_frame-1` (shape = [N])
+        within `neighbor_radius` meters and/or the nearest `neighbor_k`.
+        returns: a `RaggedList` of agent indexes for each query, or `None` if neighbors are not limited
+        """
+        if not (self.neighbor_radius > 0 or self.neighbor_k > 0):
+            return None
+
+        agent_index = np.asarray(agent_index, dtype=np.int64).reshape([-1])
+        obs_frame = np.asarray(obs_frame, dtype=np.int64).reshape([-1])
+        rows = []
+        values = []
+        for frame in np.unique(obs_frame):
+            query_index = np.where(obs_frame == frame)[0]
+            positions = np.stack([self.agent_data[agent].get_traj(frame-1, frame)[0] for agent in agent_index[query_index]])
+            neighbors = self.get_spatial_index(frame-1).query(
+                positions, 
+                radius=self.neighbor_radius, 
+                k=self.neighbor_k, 
+                exclude=agent_index[query_index],
+            )
+            rows.append(np.repeat(query_index, np.diff(neighbors.offsets)))
+            values.append(neighbors.values)
+
+        rows = np.concatenate(rows + [np.zeros([0], dtype=np.int64)])
+        values = np.concatenate(values + [np.zeros([0], dtype=np.int64)])
+        return ragged_from_rows(rows, values, len(agent_index))
+
+    def get_neighbor_batch(self, agent_index, obs_frame, obs_length, max_neighbors=None):
+        """
+        Gather observed trajectories of neighbors (all other agents in frame `obs_frame-1`) for a batch of windows.
+        `agent_index`, `obs_frame`: target agent and observation frame of each window, shape = [N]
+        `max_neighbors`: neighbors kept for each window, `None` for the max number of neighbors in this batch
+        returns: `neighbor_traj` (shape = [N, max_neighbors, obs_length, 2]), `mask` (shape = [N, max_neighbors]),
+            and `neighbor_index` (-1 for padding, shape = [N, max_neighbors])
+        """
+        agent_index = np.asarray(agent_index, dtype=np.int64).reshape([-1])
+        obs_frame = np.asarray(obs_frame, dtype=np.int64).reshape([-1])
+        frames, frame_inverse = np.unique(obs_frame, return_inverse=True)
+        frame_neighbors = [self.get_frame_neighbors(frame, obs_length) for frame in frames]
+
+        # neighbors of all frames in this batch as a flat list (CSR)
+        counts = np.array([len(index) for index, _ in frame_neighbors], dtype=np.int64).reshape([-1])
+        offsets = np.concatenate([[0], np.cumsum(counts)])
+        all_index = np.concatenate([index for index, _ in frame_neighbors] + [-np.ones([1], dtype=np.int64)])
+        all_traj = np.concatenate([traj for _, traj in frame_neighbors] + [np.zeros([1, obs_length, 2])], axis=0)
+
+        slots = np.arange(np.max(counts) if len(counts) else 0)
+        valid = slots < counts[frame_inverse][:, np.newaxis]
+        source = np.where(valid, offsets[frame_inverse][:, np.newaxis] + slots, len(all_index) - 1)
+        valid = valid & np.not_equal(all_index[source], agent_index[:, np.newaxis])
+
+        neighbor_limit = self.limit_neighbors(agent_index, obs_frame)
+        if neighbor_limit:
+            # keep pairs (window, neighbor) given by the spatial index
+            person_number = self.person_number + 1
+            pairs = np.repeat(np.arange(len(agent_index)), np.diff(neighbor_limit.offsets)) * person_number + neighbor_limit.values
+            valid = valid & np.isin(np.arange(len(agent_index))[:, np.newaxis] * person_number + all_index[source], pairs)
+
+        # move valid neighbors to the front of each window
+        rank = np.cumsum(valid, axis=1) - 1
+        if max_neighbors is None:
+            max_neighbors = np.max(rank[:, -1] + 1) if rank.size else 0
+        keep = valid & (rank < max_neighbors)
+        window, slot = np.nonzero(keep)
+
+        neighbor_traj = np.zeros([len(agent_index), max_neighbors, obs_length, 2])
+        mask = np.zeros([len(agent_index), max_neighbors], dtype=bool)
+        neighbor_index = -np.ones([len(agent_index), max_neighbors], dtype=np.int64)
+        neighbor_traj[window, rank[window, slot]] = all_traj[source[window, slot]]
+        mask[window, rank[window, slot]] = True
+        neighbor_index[window, rank[window, slot]] = all_index[source[window, slot]]
+        return neighbor_traj, mask, neighbor_index
+
+    def get_trajectory(self, agent_index, start_frame, obs_frame, end_frame, calculate_social=True, normalization=False, add_noise=False, reverse=False, rotate=False, neighbor_traj=None):
+        """
+        `neighbor_traj`: neighbors of this window given by `get_neighbor_batch`, gathered here if `None`
+        """
         target_agent = self.agent_data[agent_index]
         frame_list = target_agent.frame_list
-        neighbor_list = target_agent.video_neighbor_list[obs_frame-1].tolist()
-        neighbor_list = set(neighbor_list) - set([agent_index])
-        neighbor_agents = [self.agent_data[nei] for nei in neighbor_list]
+        if add_noise or reverse or rotate:
+            neighbor_traj = np.zeros([0, obs_frame - start_frame, 2])    # virtual agents (`Agent_Part`) do not keep neighbors
+        elif neighbor_traj is None:
+            neighbor_index, neighbor_traj = self.get_frame_neighbors(obs_frame, obs_frame - start_frame)
+            neighbor_limit = self.limit_neighbors([agent_index], [obs_frame])
+            if neighbor_limit:
+                neighbor_traj = neighbor_traj[np.isin(neighbor_index, neighbor_limit[0])]   # copy
+            else:
+                neighbor_traj = neighbor_traj[np.not_equal(neighbor_index, agent_index)]    # copy
 
         return Agent_Part(
-            target_agent, neighbor_agents, frame_list, start_frame, obs_frame, end_frame, calculate_social=calculate_social, normalization=normalization, add_noise=add_noise, reverse=reverse, rotate=rotate
+            target_agent, neighbor_traj, frame_list, start_frame, obs_frame, end_frame, calculate_social=calculate_social, normalization=normalization, add_noise=add_noise, reverse=reverse, rotate=rotate
         )
         
 
 class Agent():
     def __init__(self, agent_index, video_neighbor_list, video_matrix, frame_list, init_position):
         self.agent_index = agent_index
-        self.traj = video_matrix[:, agent_index, :]
         self.video_neighbor_list = video_neighbor_list
         self.frame_list = frame_list
+        self.init_position = init_position
+
+        if type(video_matrix) == TrajectoryStore:
+            # `traj` only covers frames `[start_frame, end_frame)`
+            self.start_frame, self.end_frame, self.traj = video_matrix.get_span(agent_index, init_position)
+            self.traj_offset = self.start_frame
+        else:
+            self.traj = video_matrix[:, agent_index, :]
+            self.traj_offset = 0
+            self.start_frame = np.where(np.not_equal(self.traj.T[0], init_position))[0][0]
+            self.end_frame = np.where(np.not_equal(self.traj.T[0], init_position))[0][-1] + 1    # 取不到
+
+    def get_traj(self, start_frame, end_frame):
+        """
+        Get trajectory in frames `[start_frame, end_frame)`.
+        Frames that are not stored are filled with `init_position`.
+        """
+        start = start_frame - self.traj_offset
+        end = end_frame - self.traj_offset
+        if start >= 0 and end <= len(self.traj):
+            return self.traj[start:end]
 
-        self.start_frame = np.where(np.not_equal(self.traj.T[0], init_position))[0][0]
-        self.end_frame = np.where(np.not_equal(self.traj.T[0], init_position))[0][-1] + 1    # 取不到
+        traj = self.init_position * np.ones([end_frame - start_frame, 2])
+        copy_start = np.maximum(start, 0)
+        copy_end = np.minimum(end, len(self.traj))
+        if copy_start < copy_end:
+            traj[copy_start-start:copy_end-start] = self.traj[copy_start:copy_end]
+        return traj
 
 
 class Agent_Part():
-    def __init__(self, target_agent, neighbor_agents, frame_list, start_frame, obs_frame, end_frame, calculate_social=True, normalization=False, add_noise=False, reverse=False, rotate=False):        
+    def __init__(self, target_agent, neighbor_traj, frame_list, start_frame, obs_frame, end_frame, calculate_social=True, normalization=False, add_noise=False, reverse=False, rotate=False):        
+        """
+        `neighbor_traj`: observed trajectories of neighbors (given by `DatasetManager.get_frame_neighbors`), shape = [M, obs_length, 2]
+        """
         # Trajectory info
         self.start_frame = start_frame
         self.obs_frame = obs_frame
@@ -446,10 +1243,10 @@ class Agent_Part():
         self.traj_map = 'null'
 
         # Trajectory
-        self.traj = target_agent.traj[start_frame:end_frame]
+        self.traj = target_agent.get_traj(start_frame, end_frame)
         if add_noise:
             noise_curr = np.random.normal(0, 0.1, size=self.traj.shape)
-            self.traj += noise_curr
+            self.traj = self.traj + noise_curr
             self.vertual_agent = True
 
         elif reverse:
@@ -471,14 +1268,8 @@ class Agent_Part():
 
         # Neighbor info
         if not self.vertual_agent:
-            self.neighbor_traj = []
-            for neighbor in neighbor_agents:
-                neighbor_traj = neighbor.traj[start_frame:obs_frame]
-                neighbor_traj[0:np.maximum(neighbor.start_frame, start_frame)-start_frame] = neighbor_traj[np.maximum(neighbor.start_frame, start_frame)-start_frame]
-                neighbor_traj[np.minimum(neighbor.end_frame, obs_frame)-start_frame:obs_frame-start_frame] = neighbor_traj[np.minimum(neighbor.end_frame, obs_frame)-start_frame-1]
-                self.neighbor_traj.append(neighbor_traj)
-            
-            self.neighbor_number = len(neighbor_agents)
+            self.neighbor_traj = [traj for traj in np.array(neighbor_traj)]   # copy, do not write into shared data
+            self.neighbor_number = len(self.neighbor_traj)
 
         # Initialize
         self.need_to_fix = False
@@ -509,7 +1300,7 @@ class Agent_Part():
         if not self.need_to_fix:
             return
         
-        self.traj += self.start_point
+        self.traj = self.traj + self.start_point
         self.pred += self.start_point
 
         self.need_to_fix = False
@@ -559,49 +1350,17 @@ class Agent_Part():
         self.neighbor_pred = self.pred_fix_neighbor(pred)
 
     def write_traj_map(self, trajmap:TrajectoryMapManager):
-        full_map = trajmap.traj_map
-        half_size = 16  # half of map size, in map size
         if not self.rotate:
             center_pos = trajmap.real2map(self.traj_train[-1])
         else:
             center_pos = trajmap.real2map(self.traj_original[self.obs_length])
-            
-        original_map = cv2.resize(full_map[
-            np.maximum(center_pos[0]-2*half_size, 0):np.minimum(center_pos[0]+2*half_size, full_map.shape[0]), 
-            np.maximum(center_pos[1]-2*half_size, 0):np.minimum(center_pos[1]+2*half_size, full_map.shape[1]),
-        ], (4*half_size, 4*half_size))
-
-        final_map = original_map[half_size:3*half_size, half_size:3*half_size]
-        if self.reverse:
-            final_map = np.flip(original_map[half_size:3*half_size, half_size:3*half_size])
-
-        if self.rotate:
-            final_map = cv2.warpAffine(
-                original_map,
-                cv2.getRotationMatrix2D(
-                    (2*half_size, 2*half_size),
-                    self.rotate,
-                    1,
-                ),
-                (4*half_size, 4*half_size),
-            )
-            final_map = final_map[half_size:3*half_size, half_size:3*half_size]
-        self.traj_map = final_map
+        self.traj_map = trajmap.get_patch(center_pos, rotate=self.rotate, reverse=self.reverse)
 
     def write_traj_map_for_neighbors(self, trajmap:TrajectoryMapManager):
         self.traj_map_neighbors = []
-        full_map = trajmap.traj_map
-        half_size = 16
-
         for nei_traj in self.get_neighbor_traj():
             center_pos = trajmap.real2map(nei_traj[-1, :])
-            original_map = cv2.resize(full_map[
-                np.maximum(center_pos[0]-2*half_size, 0):np.minimum(center_pos[0]+2*half_size, full_map.shape[0]), 
-                np.maximum(center_pos[1]-2*half_size, 0):np.minimum(center_pos[1]+2*half_size, full_map.shape[1]),
-            ], (4*half_size, 4*half_size))
-            final_map = original_map[half_size:3*half_size, half_size:3*half_size]
-            self.traj_map_neighbors.append(final_map)
-
+            self.traj_map_neighbors.append(trajmap.get_patch(center_pos))
 
     def calculate_loss(self, loss_function=calculate_ADE_FDE_numpy, SR=False):
         if SR and self.sr:
@@ -0,0 +1,444 @@
+'''
+@Description: benchmarks on synthetic data
+'''
+import argparse
+import os
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from main import get_parser as get_model_parser
+from models import BGM
+from PrepareTrainData import FrameSpatialIndex, WindowSamples, split_trajectory_data
+from sceneFeature import (PatchCache, StreamingTrajectoryMap,
+                          TiledTrajectoryMap, TrajectoryMapManager)
+from trainTools import EvalScheduler
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='benchmark')
+    parser.add_argument('--task', type=str, default='data_loader')
+    parser.add_argument('--rows', type=int, default=[10000, 100000, 1000000, 10000000], nargs='+')
+    parser.add_argument('--legacy_max_rows', type=int, default=100000)  # 旧实现为平方复杂度，只在较小数据上运行
+    parser.add_argument('--repeat', type=int, default=3)
+
+    # neighbors
+    parser.add_argument('--agents', type=int, default=[100, 500, 1000, 2000, 5000], nargs='+')    # 每帧行人数
+    parser.add_argument('--density', type=float, default=1.0)   # 每平方米行人数
+    parser.add_argument('--neighbor_radius', type=float, default=2.0)
+    parser.add_argument('--neighbor_k', type=int, default=6)
+
+    # trajectory maps
+    parser.add_argument('--windows', type=int, default=[1000, 10000, 100000, 1000000], nargs='+')
+    parser.add_argument('--angles', type=int, default=[0, 120, 240, 37], nargs='+')  # 旋转角度, 0表示不旋转
+    parser.add_argument('--scene_size', type=float, default=40.0)
+    parser.add_argument('--map_threads', type=int, default=[1, 2, 4, 8, 16, 32], nargs='+')
+    parser.add_argument('--scene_sizes', type=float, default=[40, 400, 2000], nargs='+')    # map_backend: 场景边长(米)
+
+    # training
+    parser.add_argument('--batch_sizes', type=int, default=[500, 2000, 5000, 20000], nargs='+')
+    parser.add_argument('--steps', type=int, default=50)    # 每种设置计时的训练步数
+    parser.add_argument('--pipeline_workers', type=int, default=0)
+    parser.add_argument('--replica_counts', type=int, default=[1, 2, 4, 8], nargs='+')
+    parser.add_argument('--replicas', type=int, default=1)  # replica_steps: 当前进程中的副本数
+    return parser
+
+
+def synthetic_recording(rows, points_per_person=20, frame_step=10, seed=0):
+    """
+    Create a synthetic recording in the layout of `true_pos_.csv` after `.T`,
+    i.e. each row is `[frame, person, y, x]`.
+    Pedestrians appear one after another with a fixed number of points each.
+    """
+    rng = np.random.RandomState(seed)
+    person_number = int(np.ceil(rows / points_per_person))
+    person = np.repeat(np.arange(person_number), points_per_person)[:rows]
+    step = np.tile(np.arange(points_per_person), person_number)[:rows]
+    start = rng.randint(0, max(person_number // 4, 1), size=person_number)
+    frame = frame_step * (start[person] + step)
+    position = np.cumsum(rng.normal(0, 0.4, size=[rows, 2]), axis=0)
+    return np.column_stack([frame, person, position]).astype(np.float64)
+
+
+def legacy_split_trajectory_data(data, order):
+    """
+    The former `DataManager.data_loader` implementation, kept for comparison.
+    """
+    frame_data = {}
+    frame_list = set(data.T[0])
+    for frame in frame_list:
+        index_current = np.where(data.T[0] == frame)[0]
+        frame_data[str(frame)] = np.column_stack([
+            data[index_current, 1],
+            data[index_current, order[0]],
+            data[index_current, order[1]],
+        ])
+
+    person_data = {}
+    person_list = set(data.T[1])
+    for person in person_list:
+        index_current = np.where(data.T[1] == person)[0]
+        person_data[str(person)] = np.column_stack([
+            data[index_current, 0],
+            data[index_current, order[0]],
+            data[index_current, order[1]],
+        ])
+    return person_data, frame_data
+
+
+def timeit(function, repeat):
+    times = []
+    for _ in range(repeat):
+        time_start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - time_start)
+    return np.min(times)
+
+
+def bench_data_loader(args):
+    print('{:>10} {:>12} {:>12}'.format('rows', 'split (s)', 'legacy (s)'))
+    for rows in args.rows:
+        data = synthetic_recording(rows)
+        t_new = timeit(lambda: split_trajectory_data(data, [3, 2]), args.repeat)
+        if rows <= args.legacy_max_rows:
+            t_old = '{:12.4f}'.format(timeit(lambda: legacy_split_trajectory_data(data, [3, 2]), 1))
+        else:
+            t_old = '{:>12}'.format('-')
+        print('{:>10} {:12.4f} {}'.format(rows, t_new, t_old))
+
+
+def synthetic_crowd(agents, density=1.0, seed=0):
+    """
+    Positions of `agents` pedestrians in one frame, uniformly distributed with `density` agents per square meter.
+    """
+    rng = np.random.RandomState(seed)
+    size = np.sqrt(agents / density)
+    return rng.uniform(0, size, size=[agents, 2])
+
+
+def brute_force_radius(positions, radius):
+    """
+    Neighbors within `radius` from the full distance matrix, for comparison.
+    """
+    distance = np.linalg.norm(positions[:, np.newaxis] - positions[np.newaxis, :], axis=-1)
+    np.fill_diagonal(distance, np.inf)
+    return np.nonzero(distance <= radius)
+
+
+def bench_neighbors(args):
+    print('{:>8} {:>12} {:>10} {:>12} {:>10} {:>12} {:>14}'.format(
+        'agents', 'all pairs', 'build (s)', 'radius (s)', 'nei/agent', 'k-nn (s)', 'distance (s)'))
+    for agents in args.agents:
+        positions = synthetic_crowd(agents, args.density)
+        agent_index = np.arange(agents)
+        t_build = timeit(lambda: FrameSpatialIndex(agent_index, positions), args.repeat)
+
+        index = FrameSpatialIndex(agent_index, positions)
+        t_radius = timeit(lambda: index.query(positions, radius=args.neighbor_radius, exclude=agent_index), args.repeat)
+        t_knn = timeit(lambda: index.query(positions, k=args.neighbor_k, exclude=agent_index), args.repeat)
+        t_brute = timeit(lambda: brute_force_radius(positions, args.neighbor_radius), 1)
+
+        neighbors = index.query(positions, radius=args.neighbor_radius, exclude=agent_index)
+        assert len(neighbors.values) == len(brute_force_radius(positions, args.neighbor_radius)[0])
+        print('{:>8} {:>12} {:10.4f} {:12.4f} {:10.2f} {:12.4f} {:14.4f}'.format(
+            agents, agents * (agents - 1), t_build, t_radius, len(neighbors.values) / agents, t_knn, t_brute))
+
+
+def synthetic_windows(windows, obs_frames=8, scene_size=40.0, seed=0):
+    """
+    Observed trajectories of `windows` random walks in a `scene_size` meters square, shape = [windows, obs_frames, 2].
+    """
+    rng = np.random.RandomState(seed)
+    start = rng.uniform(0, scene_size, size=[windows, 1, 2])
+    return start + np.cumsum(rng.normal(0, 0.3, size=[windows, obs_frames, 2]), axis=1)
+
+
+def legacy_add_to_map(trajmap:TrajectoryMapManager, val=1):
+    """
+    The former `TrajectoryMapManager.add_to_map` implementation, kept for comparison.
+    """
+    for traj in trajmap.traj:
+        map_pos = trajmap.real2map(traj)
+        trajmap.traj_map[map_pos.T[0], map_pos.T[1]] += val
+
+
+def bench_trajmap(args):
+    print('{:>10} {:>14} {:>14}'.format('windows', 'build (s)', 'legacy (s)'))
+    for windows in args.windows:
+        obs = synthetic_windows(windows)
+        t_new = timeit(lambda: TrajectoryMapManager(obs), args.repeat)
+        if windows <= args.legacy_max_rows:
+            trajmap = TrajectoryMapManager(obs)
+            t_old = '{:14.4f}'.format(timeit(lambda: legacy_add_to_map(trajmap), 1))
+        else:
+            t_old = '{:>14}'.format('-')
+        print('{:>10} {:14.4f} {}'.format(windows, t_new, t_old))
+
+
+def bench_patches(args):
+    print('{:>10} {:>7} {:>14} {:>14} {:>12} {:>12}'.format(
+        'windows', 'angle', 'batch (p/s)', 'get_patch (p/s)', 'speed-up', 'max error'))
+    for windows in args.windows:
+        obs = synthetic_windows(windows, scene_size=args.scene_size)
+        trajmap = TrajectoryMapManager(obs)
+        centers = trajmap.real2map(obs[:, -1])
+        for angle in args.angles:
+            angles = angle * np.ones(windows)
+            t_new = timeit(lambda: trajmap.extract_patches(centers, angles=angles), args.repeat)
+            if windows <= args.legacy_max_rows:
+                t_old = timeit(lambda: [trajmap.get_patch(center, rotate=angle) for center in centers], 1)
+                error = np.max(np.abs(
+                    trajmap.extract_patches(centers, angles=angles) 
+                    - np.stack([trajmap.get_patch(center, rotate=angle) for center in centers])
+                ))
+                t_old, speed_up, error = '{:14.0f}'.format(windows / t_old), '{:11.2f}x'.format(t_old / t_new), '{:12.2e}'.format(error)
+            else:
+                t_old, speed_up, error = '{:>14}'.format('-'), '{:>12}'.format('-'), '{:>12}'.format('-')
+            print('{:>10} {:>7} {:14.0f} {} {} {}'.format(windows, angle, windows / t_new, t_old, speed_up, error))
+
+
+def bench_map_threads(args):
+    print('CPU cores: {}'.format(os.cpu_count()))
+    print('{:>10} {:>7} {:>8} {:>14} {:>10}'.format('windows', 'angle', 'threads', 'patches/s', 'speed-up'))
+    for windows in args.windows:
+        obs = synthetic_windows(windows, scene_size=args.scene_size)
+        trajmap = TrajectoryMapManager(obs)
+        centers = trajmap.real2map(obs[:, -1])
+        for angle in args.angles:
+            angles = angle * np.ones(windows)
+            t_base = None
+            for threads in args.map_threads:
+                t = timeit(lambda: trajmap.extract_patches(centers, angles=angles, threads=threads), args.repeat)
+                t_base = t if t_base is None else t_base
+                print('{:>10} {:>7} {:>8} {:14.0f} {:9.2f}x'.format(windows, angle, threads, windows / t, t_base / t))
+
+
+def bench_patch_paths(args):
+    """
+    Patches read serially, with threads and through `PatchCache` should be the same,
+    including the decay scale of `StreamingTrajectoryMap` (applied once).
+    """
+    print('{:>10} {:>7} {:>10} {:>14} {:>14} {:>14}'.format(
+        'windows', 'angle', 'map', 'threads error', 'cache error', 'cached error'))
+    for windows in args.windows:
+        obs = synthetic_windows(windows, scene_size=args.scene_size)
+        stream = StreamingTrajectoryMap(half_life=10, init_center=[args.scene_size / 2] * 2)
+        for frame, frame_obs in enumerate(np.array_split(obs, 20)):
+            stream.add(frame_obs, 10 * frame)
+
+        for name, trajmap in [['dense', TrajectoryMapManager(obs)], ['tiled', TiledTrajectoryMap(obs)], ['stream', stream]]:
+            centers = trajmap.real2map(obs[:, -1])
+            for angle in args.angles:
+                angles = angle * np.ones(windows)
+                serial = trajmap.extract_patches(centers, angles=angles)
+                threaded = trajmap.extract_patches(centers, angles=angles, threads=4, batch_size=256)
+                cache = PatchCache(windows)
+                cached = [trajmap.extract_patches(centers, angles=angles, cache=cache, threads=4, batch_size=256) for _ in range(2)]
+                print('{:>10} {:>7} {:>10} {:14.2e} {:14.2e} {:14.2e}'.format(
+                    windows, angle, name, 
+                    np.max(np.abs(threaded - serial)),
+                    np.max(np.abs(cached[0] - serial)),     # sampled and written to the cache
+                    np.max(np.abs(cached[1] - serial)),     # read from the cache
+                ))
+
+
+def bench_stream_decay(args):
+    """
+    A `StreamingTrajectoryMap` advanced over more than 256 half-lives (so stored values are rescaled)
+    should keep decayed values, i.e. the same map as adding each trajectory with its decayed weight directly.
+    """
+    print('{:>10} {:>10} {:>8} {:>12} {:>12}'.format('windows', 'half life', 'frames', 'max value', 'max error'))
+    for windows in args.windows:
+        obs = synthetic_windows(windows, scene_size=args.scene_size)
+        for half_life in [1, 10]:
+            frames = np.array([0, 200, 300, 3000, 3001, 3005]) * half_life
+            stream = StreamingTrajectoryMap(half_life=half_life, init_center=[args.scene_size / 2] * 2)
+            direct = StreamingTrajectoryMap(init_center=[args.scene_size / 2] * 2)
+            for frame, frame_obs in zip(frames, np.array_split(obs, len(frames))):
+                stream.add(frame_obs, frame)
+                direct.add(frame_obs, frame, val=2.0 ** (-(frames[-1] - frame) / half_life))
+
+            values = stream.traj_map * stream.read_scale()
+            error = np.max(np.abs(values - direct.traj_map)) / np.maximum(np.max(direct.traj_map), 1e-12)
+            print('{:>10} {:>10} {:>8} {:12.4f} {:12.2e}'.format(windows, half_life, frames[-1], np.max(values), error))
+            assert error < 1e-9, 'decayed streaming map does not match'
+
+
+def bench_eval_schedule(args):
+    """
+    `EvalScheduler` should evaluate once in each interval of `test_step` epochs,
+    also when batches are larger than the training data and skip epochs.
+    """
+    print('{:>10} {:>12} {:>12} {}'.format('test_step', 'epochs/batch', 'start_epoch', 'evaluated epochs'))
+    for test_step, epochs_per_batch, start_epoch in [[1, 0.5, 0], [3, 1, 0], [5, 3, 0], [5, 3, 7], [2, 7, 0]]:
+        scheduler = EvalScheduler(every_epochs=test_step, start_epoch=start_epoch)
+        epochs = [int(batch * epochs_per_batch) for batch in range(int(40 / epochs_per_batch) + 1)]
+        evaluated = [epoch for epoch in epochs if scheduler.should_eval(epoch)]
+        print('{:>10} {:>12} {:>12} {}'.format(test_step, epochs_per_batch, start_epoch, evaluated))
+
+        intervals = [epoch // test_step for epoch in evaluated]
+        expected = sorted(set(epoch // test_step for epoch in epochs if (epoch // test_step) * test_step >= start_epoch))
+        assert intervals == expected, 'not evaluated exactly once in each interval'
+
+
+def bench_map_backend(args):
+    print('{:>10} {:>10} {:>8} {:>12} {:>10} {:>14} {:>12}'.format(
+        'windows', 'scene (m)', 'backend', 'memory (MB)', 'build (s)', 'patches/s', 'max error'))
+    for windows in args.windows:
+        for scene_size in args.scene_sizes:
+            obs = synthetic_windows(windows, scene_size=scene_size)
+            dense = TrajectoryMapManager(obs)
+            centers = dense.real2map(obs[:, -1])
+            dense_patches = dense.extract_patches(centers)
+            for backend in [TrajectoryMapManager, TiledTrajectoryMap]:
+                t_build = timeit(lambda: backend(obs), args.repeat)
+                trajmap = backend(obs)
+                t_patch = timeit(lambda: trajmap.extract_patches(centers), args.repeat)
+                error = np.max(np.abs(trajmap.extract_patches(centers) - dense_patches))
+                print('{:>10} {:>10.0f} {:>8} {:12.2f} {:10.4f} {:14.0f} {:12.2e}'.format(
+                    windows, scene_size, 'dense' if backend == TrajectoryMapManager else 'tiled',
+                    trajmap.memory_size() / 2**20, t_build, windows / t_patch, error,
+                ))
+
+
+def synthetic_bgm(windows, model_args=[]):
+    """
+    A `BGM` model (created but not trained) whose training data are `windows` synthetic windows.
+    `model_args`: args of `main.py`, e.g. `['--batch_size', '500']`
+    """
+    traj = synthetic_windows(windows, obs_frames=20)
+    obs = traj[:, :8]
+    trajmap = TrajectoryMapManager(obs)
+    samples = WindowSamples(
+        obs=obs.astype(np.float32),
+        gt=traj[:, 8:].astype(np.float32),
+        maps=trajmap.extract_patches(trajmap.real2map(obs[:, -1])).astype(np.float32),
+        offset=np.zeros([windows, 2]),
+        **{name: np.zeros(windows, dtype=np.int64) for name in WindowSamples.names[4:]},
+    )
+    args = get_model_parser().parse_args(['--log_dir', tempfile.mkdtemp()] + model_args)
+    model = BGM(train_info=dict(
+        train_data=samples, 
+        test_data=[], 
+        train_number=windows, 
+        sample_time=1, 
+        augmentation=None,
+    ), args=args)
+    model.get_data()
+    model.model, model.optimizer = model.build_model()
+    return model
+
+
+def time_train_steps(model, steps):
+    """
+    Seconds per training step of `model` (after one warm-up step) with its `args.input_pipeline`.
+    """
+    train_tensor, _ = model.prepare_model_inputs_arrays(model.train_data)
+    model.prepare_model_inputs_batch(train_tensor, init=True)
+    batches = model.get_train_batches(train_tensor)
+    model.train_step(*next(batches)[:2])
+
+    time_start = time.perf_counter()
+    for _ in range(steps):
+        model_inputs, gt, _ = next(batches)
+        model.train_step(model_inputs, gt)
+    return (time.perf_counter() - time_start) / steps
+
+
+def bench_input_pipeline(args):
+    print('{:>10} {:>10} {:>10} {:>12} {:>10}'.format('windows', 'batch', 'pipeline', 'steps/s', 'speed-up'))
+    for windows in args.windows:
+        for batch_size in args.batch_sizes:
+            t_base = None
+            for pipeline in ['slice', 'dataset']:
+                model = synthetic_bgm(windows, [
+                    '--batch_size', str(batch_size), 
+                    '--input_pipeline', pipeline, 
+                    '--pipeline_workers', str(args.pipeline_workers),
+                ])
+                t = time_train_steps(model, args.steps)
+                t_base = t if t_base is None else t_base
+                print('{:>10} {:>10} {:>10} {:12.2f} {:9.2f}x'.format(windows, batch_size, pipeline, 1 / t, t_base / t))
+
+
+def bench_train_step(args):
+    print('{:>10} {:>20} {:>14} {:>10}'.format('batch', 'step', 'latency (ms)', 'speed-up'))
+    for batch_size in args.batch_sizes:
+        t_base = None
+        for name, compile_args in [
+            ['eager', []], 
+            ['function', ['--compile_step', '1']], 
+            ['xla', ['--compile_step', '1', '--jit_compile', '1']],
+        ]:
+            # windows are not a multiple of the batch size, so partial batches are included
+            model = synthetic_bgm(int(2.5 * batch_size), ['--batch_size', str(batch_size)] + compile_args)
+            t = time_train_steps(model, args.steps)
+            t_base = t if t_base is None else t_base
+            if model.compiled_train_step is not None:
+                name = '{} ({} traces)'.format(name, model.compiled_train_step.experimental_get_tracing_count())
+            print('{:>10} {:>20} {:14.2f} {:9.2f}x'.format(batch_size, name, 1000 * t, t_base / t))
+
+
+def bench_replica_steps(args):
+    """
+    Print seconds per training step with `args.replicas` replicas (run in a new process by `bench_replicas`,
+    since logical devices must be created before TensorFlow is initialized).
+    """
+    if args.replicas > 1:
+        cpus = tf.config.list_physical_devices(device_type='CPU')
+        tf.config.set_logical_device_configuration(cpus[0], [tf.config.LogicalDeviceConfiguration() for _ in range(args.replicas)])
+
+    batch_size = args.batch_sizes[0]
+    model = synthetic_bgm(int(2.5 * batch_size), [
+        '--batch_size', str(batch_size),
+        '--replicas', str(args.replicas),
+        '--compile_step', '1',
+    ])
+    print(time_train_steps(model, args.steps))
+
+
+def bench_replicas(args):
+    print('CPU cores: {}'.format(os.cpu_count()))
+    print('{:>10} {:>9} {:>14} {:>12} {:>10} {:>11}'.format('batch', 'replicas', 'latency (ms)', 'samples/s', 'speed-up', 'efficiency'))
+    for batch_size in args.batch_sizes:
+        t_base = None
+        for replicas in args.replica_counts:
+            output = subprocess.run([
+                sys.executable, sys.argv[0], 
+                '--task', 'replica_steps', 
+                '--replicas', str(replicas), 
+                '--batch_sizes', str(batch_size), 
+                '--steps', str(args.steps),
+            ], stdout=subprocess.PIPE, check=True, universal_newlines=True).stdout
+            t = float(output.strip().split('\n')[-1])
+            t_base = t if t_base is None else t_base
+            print('{:>10} {:>9} {:14.2f} {:12.0f} {:9.2f}x {:10.1f}%'.format(
+                batch_size, replicas, 1000 * t, batch_size / t, t_base / t, 100 * t_base / t / replicas,
+            ))
+
+
+TASKS = {
+    'data_loader': bench_data_loader,
+    'neighbors': bench_neighbors,
+    'trajmap': bench_trajmap,
+    'patches': bench_patches,
+    'map_threads': bench_map_threads,
+    'patch_paths': bench_patch_paths,
+    'stream_decay': bench_stream_decay,
+    'eval_schedule': bench_eval_schedule,
+    'map_backend': bench_map_backend,
+    'input_pipeline': bench_input_pipeline,
+    'train_step': bench_train_step,
+    'replica_steps': bench_replica_steps,
+    'replicas': bench_replicas,
+}
+
+
+if __name__ == '__main__':
+    args = get_parser().parse_args()
+    TASKS[args.task](args)
@@ -0,0 +1,100 @@
+'''
+@Description: content-addressed cache of preprocessed datasets
+'''
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+
+CACHE_VERSION = 3   # 修改缓存内容的格式时需要增加
+
+
+def file_hash(file_path, chunk_size=1 << 20):
+    """
+    sha1 of the content of `file_path`.
+    """
+    sha = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def params_key(**params):
+    """
+    Key of a cache entry created from `params`.
+    """
+    sha = hashlib.sha1()
+    sha.update(json.dumps(
+        dict(params, cache_version=CACHE_VERSION),
+        sort_keys=True,
+        default=str,
+    ).encode())
+    return sha.hexdigest()
+
+
+def cache_key(file_path, **params):
+    """
+    Key of a cache entry, i.e. sha1 of the source file and all parameters used to create the entry.
+    """
+    return params_key(source=file_hash(file_path), **params)
+
+
+def save_arrays(save_dir, arrays:dict, key):
+    """
+    Save `arrays` (without pickle) as `save_dir/{name}.npy`, together with `key`.
+    Files are written to a temporary directory which is then renamed to `save_dir`,
+    so readers never see a half-written entry.
+    """
+    temp_dir = '{}.tmp{}'.format(save_dir, os.getpid())
+    if os.path.exists(temp_dir):
+        shutil.rmtree(temp_dir)
+    os.makedirs(temp_dir)
+
+    for name in arrays:
+        np.save(os.path.join(temp_dir, '{}.npy'.format(name)), arrays[name], allow_pickle=False)
+    with open(os.path.join(temp_dir, 'cache_key.txt'), 'w') as f:
+        f.write(key)
+
+    # replace an old (broken) entry
+    if os.path.exists(save_dir):
+        old_dir = '{}.old{}'.format(save_dir, os.getpid())
+        try:
+            os.rename(save_dir, old_dir)
+            shutil.rmtree(old_dir, ignore_errors=True)
+        except OSError:
+            pass
+
+    try:
+        os.rename(temp_dir, save_dir)
+    except OSError:
+        # another process has just written the same entry
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+def load_arrays(save_dir, names:list, key, mmap_mode='r'):
+    """
+    Load arrays `names` saved by `save_arrays`.
+    Arrays are memory-mapped (`mmap_mode`), so processes reading the same entry share the page cache
+    and data is only read from disk when it is used.
+    returns: a `dict` of arrays, or `None` if the entry does not exist, is broken, or was saved with another `key`
+    """
+    key_path = os.path.join(save_dir, 'cache_key.txt')
+    if not os.path.exists(key_path):
+        return None
+
+    try:
+        with open(key_path, 'r') as f:
+            if not f.read() == key:
+                return None
+
+        return {name: np.load(
+            os.path.join(save_dir, '{}.npy'.format(name)),
+            mmap_mode=mmap_mode,
+            allow_pickle=False,
+        ) for name in names}
+
+    except (OSError, ValueError):
+        return None
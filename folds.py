@@ -0,0 +1,135 @@
+'''
+@Description: train or test all leave-one-out folds with one entry point
+'''
+import copy
+import os
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+import numpy as np
+import tensorflow as tf
+from tensorflow import keras
+
+from helpmethods import dir_check
+from main import get_model, get_parser, gpu_config, load_args, set_log_dir
+from PrepareTrainData import DataManager
+
+
+def get_folds_parser():
+    parser = get_parser()
+    parser.description = 'train or test all leave-one-out folds'
+    parser.add_argument('--test_sets', type=int, default=[0, 1, 2, 3, 4], nargs='+')     # 依次作为测试集的数据集
+    parser.add_argument('--fold_workers', type=int, default=0)     # 并行训练fold的进程数, 0表示在当前进程中依次训练
+    parser.add_argument('--fold_threads', type=int, default=0)     # 每个fold使用的tensorflow线程数 (intra/inter op), 0表示不限制
+    parser.add_argument('--fold_loads', type=str, default=[], nargs='+')
+    # 与test_sets一一对应的模型路径 (同 --load), 给出时只测试这些模型, 否则训练所有fold
+    return parser
+
+
+def set_threads(args, threads=0):
+    """
+    Config devices and pin the number of threads used by tensorflow in the current process.
+    Must be called before tensorflow runs any op.
+    """
+    gpu_config(args)
+    if threads > 0:
+        os.environ['OMP_NUM_THREADS'] = str(threads)
+        tf.config.threading.set_intra_op_parallelism_threads(threads)
+        tf.config.threading.set_inter_op_parallelism_threads(threads)
+
+
+def get_fold_args(args, test_set, load='null'):
+    """
+    Args of the fold `test_set`, including its own `log_dir` (`{log_dir}/{test_set}` if `--log_dir` is given).
+    """
+    fold_args = copy.deepcopy(args)
+    fold_args.test_set = test_set
+    fold_args.load = load
+    if load == 'null':
+        if not args.log_dir == 'null':
+            os.makedirs(args.log_dir, exist_ok=True)    # `dir_check` only creates the last level
+            fold_args.log_dir = os.path.join(args.log_dir, str(test_set))
+        return set_log_dir(fold_args)
+    return load_args(load + 'args.npy', fold_args)
+
+
+def run_fold(args, train_info):
+    """
+    Train (or test, if `args.load` is given) the model of one fold.
+    returns: `(test_set, [ADE, FDE], seconds)`
+    """
+    time_start = time.time()
+    model = get_model(args)(train_info=train_info, args=args)
+    model.run_commands()
+    test_loss = model.test_loss if model.test_loss is not None else np.array([np.nan, np.nan])
+    keras.backend.clear_session()   # 释放模型, 下一个fold在同一进程中运行
+    return args.test_set, test_loss, time.time() - time_start
+
+
+def prepare_folds(args):
+    """
+    Load and sample every dataset used by `args.test_sets` only once.
+    returns: `[train_info of each fold]`
+    """
+    data_args = copy.deepcopy(args)
+    data_args.log_dir = args.save_base_dir
+    data_manager = DataManager(data_args, prepare_data=False)
+    if not args.train_type == 'all':
+        train_info = []
+        for test_set in args.test_sets:
+            data_manager.args = get_fold_args(args, test_set)
+            train_info.append(data_manager.get_train_and_test_agents())
+        return train_info
+
+    # 只对没有缓存训练数据的fold取样所需的数据集
+    train_datasets = dict()
+    for test_set in args.test_sets:
+        if data_manager.load_train_samples(test_set) is None:
+            train_datasets.update(zip(*data_manager.get_train_list(test_set)))
+
+    print('Sample datasets {} for test sets {}...'.format(sorted(train_datasets), args.test_sets))
+    dataset_samples, test_agents = data_manager.sample_datasets(train_datasets, args.test_sets)
+    return [data_manager.get_all_train_info(test_set, dataset_samples, test_agents) for test_set in args.test_sets]
+
+
+def main():
+    args = get_folds_parser().parse_args()
+    dir_check('./results')
+
+    if len(args.fold_loads):
+        if not len(args.fold_loads) == len(args.test_sets):
+            raise ValueError('Give one model path in `--fold_loads` for each of `--test_sets` {}.'.format(args.test_sets))
+        fold_args = [get_fold_args(args, test_set, load) for test_set, load in zip(args.test_sets, args.fold_loads)]
+        train_info = [0 for _ in args.test_sets]
+    else:
+        fold_args = [get_fold_args(args, test_set) for test_set in args.test_sets]
+        train_info = prepare_folds(args)
+
+    time_start = time.time()
+    if args.fold_workers > 0:
+        with ProcessPoolExecutor(
+            max_workers=args.fold_workers,
+            mp_context=get_context('spawn'),
+            initializer=set_threads,
+            initargs=(args, args.fold_threads),
+        ) as executor:
+            results = list(executor.map(run_fold, fold_args, train_info))
+    else:
+        set_threads(args, args.fold_threads)
+        results = [run_fold(current_args, current_info) for current_args, current_info in zip(fold_args, train_info)]
+
+    print('-----------------Folds-----------------')
+    print('test_set\tADE\tFDE\ttime(s)')
+    for (test_set, test_loss, seconds), current_args in zip(results, fold_args):
+        print('{}\t{:.4f}\t{:.4f}\t{:.1f}'.format(test_set, test_loss[0], test_loss[1], seconds))
+        if len(args.fold_loads):
+            np.savetxt('./results/test-{}{}.txt'.format(current_args.model_name, test_set), test_loss)
+
+    mean_loss = np.mean(np.stack([test_loss for _, test_loss, _ in results]), axis=0)
+    print('mean\t{:.4f}\t{:.4f}\t{:.1f} (total)'.format(mean_loss[0], mean_loss[1], time.time() - time_start))
+
+
+if __name__ == "__main__":
+    main()
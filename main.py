@@ -52,22 +52,51 @@ def get_parser():
     parser.add_argument('--add_noise', type=int, default=False)         # 训练数据添加噪声
     parser.add_argument('--rotate', type=int, default=False)            # 旋转训练数据(起始点保持不变)
     parser.add_argument('--normalization', type=int, default=False)
+    parser.add_argument('--trajectory_store', type=str, default='dense')
+    # 'dense': 使用 [frame_number, person_number, 2] 的 video_matrix
+    # 'ragged': 使用按行人存储的稀疏轨迹 (TrajectoryStore)
+    parser.add_argument('--prep_workers', type=int, default=0)       # 并行加载训练数据集的进程数, 0表示不使用多进程
+    parser.add_argument('--sample_cache', type=int, default=True)    # 缓存取样后的训练数据
+    parser.add_argument('--map_threads', type=int, default=0)    # 写入trajectory map时使用的线程数, 0表示不使用多线程 (默认); 使用前请用 benchmark.py --task map_threads 确认有加速
+    parser.add_argument('--patch_cache', type=int, default=0)    # 缓存的trajectory map patch数量 (LRU), 0表示不使用缓存
+    parser.add_argument('--map_backend', type=str, default='dense')
+    # 'dense': 覆盖所有轨迹范围的完整trajectory map
+    # 'tiled': 只保存被访问过的tile (TiledTrajectoryMap), 适用于大场景
+    parser.add_argument('--online_augment', type=int, default=False)    # 训练时对每个batch随机reverse/rotate/add_noise, 不保存增强后的训练数据
+    parser.add_argument('--input_pipeline', type=str, default='slice')
+    # 'slice': 按顺序切片训练数据
+    # 'dataset': 使用 tf.data, 每个epoch打乱顺序并预取下一个batch
+    parser.add_argument('--shuffle', type=int, default=True)    # 'dataset' 模式下每个epoch打乱训练数据
+    parser.add_argument('--pipeline_workers', type=int, default=0)    # 'dataset' 模式下并行准备(增强)batch的数量, 0表示自动选择
 
     # test settings when training
     parser.add_argument('--test', type=int, default=True)
     parser.add_argument('--start_test_percent', type=float, default=0.0)    
     parser.add_argument('--test_step', type=int, default=3)     # 训练时每test_step个epoch，test一次
+    parser.add_argument('--test_every_seconds', type=float, default=0)    # 训练时每隔多少秒test一次, 0表示按照test_step
+    parser.add_argument('--test_background', type=int, default=False)    # 在后台线程中使用权重副本test, 训练不会等待
+    parser.add_argument('--stream_map_window', type=int, default=0)    # 测试时按时间顺序增量写入trajectory map, 只保留最近的帧数, 0表示不删除
+    parser.add_argument('--stream_map_half_life', type=float, default=0)    # 增量trajectory map中轨迹权重的半衰期(帧), 两者均为0时对每个batch重新建立map
     
     # training settings
     parser.add_argument('--epochs', type=int, default=500)
     parser.add_argument('--batch_size', type=int, default=500)
     parser.add_argument('--dropout', type=float, default=0.5)
     parser.add_argument('--lr', type=float, default=1e-3)
+    parser.add_argument('--compile_step', type=int, default=False)    # 使用 tf.function 编译训练步骤
+    parser.add_argument('--jit_compile', type=int, default=False)     # 使用 XLA 编译训练步骤 (需要 compile_step)
+    parser.add_argument('--replicas', type=int, default=1)    # 数据并行训练的副本数, 没有GPU时使用同样数量的逻辑CPU设备
    
     # save/load settings
     parser.add_argument('--model_name', type=str, default='model')
     parser.add_argument('--save_model', type=int, default=True)
     parser.add_argument('--save_per_step', type=bool, default=True)
+    parser.add_argument('--keep_best', type=int, default=3)     # 保留ADE最低的checkpoint数量, 0表示全部保留
+    parser.add_argument('--keep_latest', type=int, default=0)   # 另外保留最新的checkpoint数量 (每次test都保存)
+    parser.add_argument('--log_every', type=int, default=50)    # 每log_every个batch写入一次训练loss
+    parser.add_argument('--metrics_log', type=str, default='none')
+    # 'none': 只写入tensorboard
+    # 'csv' / 'jsonl': 同时写入 metrics.csv / metrics.jsonl
 
     # Linear args
     parser.add_argument('--diff_weights', type=float, default=0.95)
@@ -80,6 +109,8 @@ def get_parser():
     parser.add_argument('--init_position', type=float, default=20)
     # parser.add_argument('--future_interaction', type=int, default=True)
     parser.add_argument('--calculate_social', type=int, default=False)
+    parser.add_argument('--neighbor_radius', type=float, default=0)    # 只使用观测最后一帧距离小于该值(米)的行人作为邻居, 0表示同一帧的所有行人
+    parser.add_argument('--neighbor_k', type=int, default=0)    # 只使用观测最后一帧最近的k个行人作为邻居, 0表示不限制
 
     # SR args
     parser.add_argument('--grid_shape_x', type=int, default=700)
@@ -103,6 +134,14 @@ def gpu_config(args):
     for gpu in gpus:
         tf.config.experimental.set_memory_growth(gpu, True)
 
+    # 没有GPU时, 将CPU分为多个逻辑设备用于数据并行训练
+    if args.replicas > 1 and not len(gpus):
+        cpus = tf.config.list_physical_devices(device_type='CPU')
+        tf.config.set_logical_device_configuration(
+            cpus[0], 
+            [tf.config.LogicalDeviceConfiguration() for _ in range(args.replicas)],
+        )
+
 
 def load_args(save_args_path, current_args):
     save_args = np.load(current_args.load+'args.npy', allow_pickle=True).item()
@@ -110,9 +149,31 @@ def load_args(save_args_path, current_args):
     save_args.load = current_args.load
     save_args.draw_results = current_args.draw_results
     save_args.sr_enable = current_args.sr_enable
+    save_args.map_threads = current_args.map_threads
+    save_args.patch_cache = current_args.patch_cache
+    save_args.map_backend = current_args.map_backend
+    save_args.replicas = current_args.replicas
+    save_args.stream_map_window = current_args.stream_map_window
+    save_args.stream_map_half_life = current_args.stream_map_half_life
     return save_args
 
 
+def set_log_dir(args):
+    if args.log_dir == 'null':
+        log_dir_current = TIME + args.model_name + args.model + str(args.test_set)
+        args.log_dir = os.path.join(dir_check(args.save_base_dir), log_dir_current)
+    else:
+        args.log_dir = dir_check(args.log_dir)
+    return args
+
+
+def get_model(args):
+    if args.model == 'bgm':
+        return BGM
+    elif args.model == 'linear':
+        return Linear
+
+
 def main():
     args = get_parser().parse_args()
     # args.frame = [int(i) for i in args.frame]
@@ -125,17 +186,8 @@ def main():
         inputs = 0
         args = load_args(args.load+'args.npy', args)
     
-    if args.log_dir == 'null':
-        log_dir_current = TIME + args.model_name + args.model + str(args.test_set)
-        args.log_dir = os.path.join(dir_check(args.save_base_dir), log_dir_current)
-    else:
-        args.log_dir = dir_check(args.log_dir)
-    
-    if args.model == 'bgm':
-        model = BGM
-    elif args.model == 'linear':
-        model = Linear
-
+    args = set_log_dir(args)
+    model = get_model(args)
     model(train_info=inputs, args=args).run_commands()
 
 
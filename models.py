@@ -7,6 +7,7 @@ LastEditTime: 2020-09-16 16:27:24
 '''
 import os
 import random
+import time
 
 import matplotlib.pyplot as plt
 import numpy as np
@@ -16,7 +17,9 @@ from tqdm import tqdm
 
 from GridRefine import SocialRefine_one
 from helpmethods import calculate_ADE_FDE_numpy, dir_check, list2array
-from sceneFeature import TrajectoryMapManager
+from PrepareTrainData import WindowSamples
+from sceneFeature import PatchCache, StreamingTrajectoryMap, create_trajectory_map
+from trainTools import CheckpointWriter, EvalScheduler, MetricsLogger
 from visual import TrajVisual
 
 
@@ -36,12 +39,15 @@ class Base_Model():
     def __init__(self, train_info, args):
         self.args = args
         self.train_info = train_info
+        self.compiled_train_step = None
+        self.strategy = None
+        self.test_loss = None   # [ADE, FDE] of the latest test
         
     def run_commands(self):
         self.get_data()     # 获取与训练数据有关的信息
 
         if self.args.load == 'null':
-            self.model, self.optimizer = self.create_model()
+            self.model, self.optimizer = self.build_model()
             self.model.summary()
             self.train()
         else:
@@ -63,14 +69,16 @@ class Base_Model():
         self.pred_frames = self.args.pred_frames
         self.total_frames = self.obs_frames + self.pred_frames
         self.log_dir = dir_check(self.args.log_dir)
+        self.patch_cache = PatchCache(self.args.patch_cache) if self.args.patch_cache > 0 else None
 
         if not self.args.load == 'null':
             return
 
-        self.agents_train = self.train_info['train_data']
+        self.train_data = self.train_info['train_data']
         self.agents_test = self.train_info['test_data']
         self.train_number = self.train_info['train_number']
         self.sample_time = self.train_info['sample_time'] 
+        self.augmentation = self.train_info['augmentation']
     
     def load_from_checkpoint(self):
         base_path = self.args.load + '{}'
@@ -87,6 +95,32 @@ class Base_Model():
         raise 'MODEL is not defined!'
         return model, optimizer
 
+    def build_model(self):
+        """
+        Create the model and optimizer, under `self.strategy` when training on several replicas.
+        """
+        self.strategy = self.create_strategy()
+        if self.strategy is None:
+            return self.create_model()
+
+        with self.strategy.scope():
+            return self.create_model()
+
+    def create_strategy(self):
+        """
+        `tf.distribute.MirroredStrategy` over `args.replicas` devices (GPUs, or logical CPU devices created
+        in `main.gpu_config`), `None` when `args.replicas <= 1`.
+        """
+        if self.args.replicas <= 1:
+            return None
+
+        devices = tf.config.list_logical_devices('GPU')
+        if not len(devices):
+            devices = tf.config.list_logical_devices('CPU')
+        devices = [device.name for device in devices[:self.args.replicas]]
+        print('Training on {} replicas: {}'.format(len(devices), devices))
+        return tf.distribute.MirroredStrategy(devices=devices)
+
     def loss(self, model_output, gt, obs='null'):
         """
         Train loss, using ADE by default
@@ -117,6 +151,14 @@ class Base_Model():
         gt = tf.cast(tf.stack(gt), tf.float32)
         return [model_inputs, gt], agent_index
 
+    def prepare_model_inputs_arrays(self, input_samples:WindowSamples):
+        """
+        Get model inputs from sampled windows (`WindowSamples`) given by `DataManager`
+        """
+        model_inputs = tf.cast(input_samples.obs, tf.float32)
+        gt = tf.cast(input_samples.gt, tf.float32)
+        return [model_inputs, gt], [i for i in range(len(gt))]
+
     def prepare_model_inputs_batch(self, train_tensor=0, batch_size=0, init=False):
         """
         Get batch data from all data
@@ -162,6 +204,141 @@ class Base_Model():
         self.batch_start = end
         return train_inputs, gt, len(gt)
 
+    def create_train_dataset(self, train_tensor):
+        """
+        `tf.data` pipeline of training batches `(model_inputs, gt)`.
+        Window indexes are shuffled every epoch (`args.shuffle`) and gathered (or augmented by `self.augmentation`)
+        in a parallel `map` (`args.pipeline_workers`), and batches are prefetched while the model is training.
+        Same as `prepare_model_inputs_batch`, batches continue across epochs.
+        """
+        train_length = len(train_tensor[1])
+        workers = self.args.pipeline_workers if self.args.pipeline_workers > 0 else tf.data.AUTOTUNE
+        model_inputs = tuple(train_tensor[0]) if type(train_tensor[0]) == list else train_tensor[0]
+        gt = train_tensor[1]
+
+        dataset = tf.data.Dataset.range(train_length)
+        if self.args.shuffle:
+            dataset = dataset.shuffle(train_length, reshuffle_each_iteration=True)
+        dataset = dataset.repeat().batch(self.args.batch_size)
+
+        if self.augmentation:
+            dataset = dataset.map(self.augment_batch_tensor, num_parallel_calls=workers)
+        else:
+            dataset = dataset.map(
+                lambda index: (tf.nest.map_structure(lambda x: tf.gather(x, index), model_inputs), tf.gather(gt, index)),
+                num_parallel_calls=workers,
+            )
+        return dataset.prefetch(tf.data.AUTOTUNE)
+
+    def augment_batch_tensor(self, index):
+        """
+        Model inputs of windows `index` after `self.augmentation`, used in `tf.data` pipelines.
+        """
+        [template_inputs, template_gt], _ = self.prepare_model_inputs_arrays(self.train_data.select(np.arange(1)))
+        flat_template = tf.nest.flatten(template_inputs) + [template_gt]
+
+        def augment(index):
+            batch_samples = self.augmentation.augment(self.train_data, index.numpy())
+            [model_inputs, gt], _ = self.prepare_model_inputs_arrays(batch_samples)
+            return tf.nest.flatten(model_inputs) + [gt]
+
+        outputs = tf.py_function(augment, [index], [tensor.dtype for tensor in flat_template])
+        for output, tensor in zip(outputs, flat_template):
+            output.set_shape([None] + tensor.shape[1:])
+
+        model_inputs = tf.nest.pack_sequence_as(template_inputs, outputs[:-1])
+        return (tuple(model_inputs) if type(model_inputs) == list else model_inputs), outputs[-1]
+
+    def get_train_batches(self, train_tensor):
+        """
+        Generator of training batches `(model_inputs, gt, sample_number)`,
+        from `create_train_dataset` if `args.input_pipeline == 'dataset'`, otherwise from `prepare_model_inputs_batch`.
+        """
+        if self.args.input_pipeline == 'dataset':
+            for model_inputs, gt in self.create_train_dataset(train_tensor):
+                yield (list(model_inputs) if type(model_inputs) == tuple else model_inputs), gt, len(gt)
+            return
+
+        while True:
+            model_inputs, gt, sample_number = self.prepare_model_inputs_batch(train_tensor, self.args.batch_size)
+            if self.augmentation and sample_number >= 20:
+                batch_samples = self.augmentation.augment(self.train_data, gt.numpy())
+                [model_inputs, gt], _ = self.prepare_model_inputs_arrays(batch_samples)
+            yield model_inputs, gt, sample_number
+
+    def train_step(self, model_inputs, gt):
+        """
+        Run one training step on a batch, in a compiled graph if `args.compile_step`.
+        returns: `loss_ADE` and the list of train losses
+        """
+        if self.strategy is not None:
+            if self.compiled_train_step is None:
+                self.compiled_train_step = self.compile_train_step(model_inputs, gt, self.apply_distributed_train_step)
+            return self.compiled_train_step(model_inputs, gt)
+
+        if self.args.compile_step:
+            if self.compiled_train_step is None:
+                self.compiled_train_step = self.compile_train_step(model_inputs, gt, self.apply_train_step)
+            return self.compiled_train_step(model_inputs, gt)
+        return self.apply_train_step(model_inputs, gt)
+
+    def compile_train_step(self, model_inputs, gt, step_function):
+        """
+        `step_function` as a `tf.function` (XLA compiled if `args.jit_compile`).
+        The batch dimension of its input signature is `None`, so the last partial batch does not retrace it.
+        """
+        def spec(tensor):
+            return tf.TensorSpec([None] + list(tensor.shape[1:]), tensor.dtype)
+
+        return tf.function(
+            step_function,
+            input_signature=[tf.nest.map_structure(spec, model_inputs), spec(gt)],
+            jit_compile=bool(self.args.jit_compile),
+        )
+
+    def apply_train_step(self, model_inputs, gt, weight=1.0):
+        """
+        `weight`: weight of the loss of this batch, i.e. its share of the whole batch when it is a shard of a replica
+        """
+        ADE_move_average = tf.cast(0.0, dtype=tf.float32)    # 计算移动平均
+        with tf.GradientTape() as tape:
+            model_output_current = self.forward_train(model_inputs)
+            loss_ADE, loss_list_current = self.loss(model_output_current, gt, obs=model_inputs)
+            ADE_move_average = 0.7 * loss_ADE + 0.3 * ADE_move_average
+            weighted_loss = weight * ADE_move_average
+
+        grads = tape.gradient(weighted_loss, self.model.trainable_variables)
+        self.optimizer.apply_gradients(zip(grads, self.model.trainable_variables))
+        return loss_ADE, loss_list_current
+
+    def apply_distributed_train_step(self, model_inputs, gt):
+        """
+        Data-parallel training step: each replica of `self.strategy` trains on one shard of the batch.
+        Losses of shards are weighted by their sizes and gradients are summed over replicas,
+        so the update is the same as training on the whole batch on one replica.
+        """
+        replicas = self.strategy.num_replicas_in_sync
+        number = tf.shape(gt)[0]
+
+        def replica_step(model_inputs, gt):
+            replica_id = tf.distribute.get_replica_context().replica_id_in_sync_group
+            start = number * replica_id // replicas
+            end = number * (replica_id + 1) // replicas
+            weight = tf.cast(end - start, tf.float32) / tf.cast(number, tf.float32)
+
+            loss_ADE, loss_list_current = self.apply_train_step(
+                tf.nest.map_structure(lambda tensor: tensor[start:end], model_inputs),
+                gt[start:end],
+                weight=weight,
+            )
+            return weight * loss_ADE, weight * loss_list_current
+
+        loss_ADE, loss_list_current = self.strategy.run(replica_step, args=(model_inputs, gt))
+        return (
+            self.strategy.reduce(tf.distribute.ReduceOp.SUM, loss_ADE, axis=None),
+            self.strategy.reduce(tf.distribute.ReduceOp.SUM, loss_list_current, axis=None),
+        )
+
     def forward_train(self, model_inputs):
         """
         Run a training implement
@@ -171,33 +348,62 @@ class Base_Model():
             output = [output]
         return output
 
-    def forward_test(self, test_tensor:list):
+    def forward_test(self, test_tensor:list, model=None):
         """
         Run test once.
         `test_tensor` is a `list`. `test_tensor[0]` is the inputs of model and `test_tensor[1]` are their grount truths.
+        `model`: model to test, `self.model` if `None`
         """
         model_inputs = test_tensor[0]
         gt = test_tensor[1]
-        output = self.model(model_inputs)
+        output = (self.model if model is None else model)(model_inputs)
         if not type(output) == list:
             output = [output]
         return output, gt, model_inputs
 
-    def test_during_training(self, test_tensor, input_agents, test_index):
+    def test_during_training(self, test_tensor, input_agents, test_index, model=None):
         """
         Run test during training.
         Results will NOT be written to inputs.
         """
-        model_output, gt, obs = self.forward_test(test_tensor)
+        model_output, gt, obs = self.forward_test(test_tensor, model=model)
         loss_eval = self.loss_eval(model_output, gt, obs=obs)
         return model_output, loss_eval, gt, input_agents
+
+    def evaluate_weights(self, weights=None):
+        """
+        Eval metrics of the test set during training.
+        `weights`: snapshot of `self.model` weights, tested on a copy of the model (`self.eval_model`) when given
+        returns: `loss_eval`, `weights`
+        """
+        if weights is None:
+            _, loss_eval, _, _ = self.test_during_training(self.test_tensor, self.agents_test, self.test_index)
+        else:
+            self.eval_model.set_weights(weights)
+            _, loss_eval, _, _ = self.test_during_training(self.test_tensor, self.agents_test, self.test_index, model=self.eval_model)
+        return loss_eval, weights
+
+    def record_eval_results(self, epoch, loss_eval, weights, test_results:list):
+        """
+        Record `loss_eval` of the test at `epoch` in `test_results` and `self.metrics_logger`, and save the checkpoint
+        (`weights` of the test, or current weights if `None`) by `self.checkpoint_writer`.
+        """
+        test_results.append(loss_eval)
+        self.metrics_logger.write(self.loss_eval_namelist, loss_eval, epoch)
+        ade_current = loss_eval[0]
+        if self.args.save_best and (ade_current <= self.best_ade or self.args.keep_latest > 0):
+            self.checkpoint_writer.save(epoch, ade_current, self.model.get_weights() if weights is None else weights)
+
+        if ade_current <= self.best_ade:
+            self.best_ade = ade_current
+            self.best_epoch = epoch
     
     def train(self):
         """
         Train the built model `self.model`
         """
         batch_number = int(np.ceil(self.train_number / self.args.batch_size))
-        summary_writer = tf.summary.create_file_writer(self.args.log_dir)
+        self.metrics_logger = MetricsLogger(self.args.log_dir, flush_every=self.args.log_every, log_format=self.args.metrics_log)
 
         print('\n-----------------dataset options-----------------')
         if self.args.train_percent[0] and self.args.train_type == 'all':
@@ -208,7 +414,14 @@ class Base_Model():
             print('Using noise data to train. ({}x)'.format(self.args.add_noise))
         if self.args.rotate:
             print('Using rotate data to train. ({}x)'.format(self.args.rotate))
+        if self.augmentation:
+            print('Using online augmentation, {} variants: {}'.format(len(self.augmentation.variants), self.augmentation.variants))
         print('train_number = {}, total {}x train samples.'.format(self.train_number, self.sample_time))
+        print('input_pipeline = {}, compile_step = {}, jit_compile = {}.'.format(
+            self.args.input_pipeline, 
+            self.args.compile_step, 
+            self.args.jit_compile,
+        ))
 
         print('-----------------training options-----------------')
         print('model_name = {}, \ndataset = {},\nbatch_number = {},\nbatch_size = {},\nlr={}'.format(
@@ -220,7 +433,12 @@ class Base_Model():
         ))
 
         print('\nPrepare training data...')
-        self.train_tensor, self.train_index = self.prepare_model_inputs_all(self.agents_train)
+        if self.augmentation:
+            # 只取样windows的序号, 每个batch的输入在增强后再计算
+            window_index = tf.range(self.train_number)
+            self.train_tensor, self.train_index = [window_index, window_index], [i for i in range(self.train_number)]
+        else:
+            self.train_tensor, self.train_index = self.prepare_model_inputs_arrays(self.train_data)
         self.test_tensor, self.test_index = self.prepare_model_inputs_all(self.agents_test)
         train_length = self.prepare_model_inputs_batch(self.train_tensor, init=True)
 
@@ -230,64 +448,74 @@ class Base_Model():
             np.save(self.test_data_save_path.format('args'), self.args)
             
         test_results = []
-        test_loss_dict = dict()
-        test_loss_dict['-'] = 0
 
         batch_number = 1 + (train_length * self.args.epochs)// self.args.batch_size
         print(batch_number, train_length, self.args.epochs, self.args.batch_size)
         
+        eval_scheduler = EvalScheduler(
+            every_epochs=self.args.test_step,
+            every_seconds=self.args.test_every_seconds,
+            start_epoch=self.args.start_test_percent * self.args.epochs,
+            background=self.args.test_background,
+        )
+        if self.args.test_background:
+            self.eval_model = keras.models.clone_model(self.model)
+        if self.args.save_best:
+            self.checkpoint_writer = CheckpointWriter(
+                keras.models.clone_model(self.model),
+                self.args.log_dir,
+                self.args.model_name,
+                keep_best=self.args.keep_best,
+                keep_latest=self.args.keep_latest,
+            )
+
         time_bar = tqdm(range(batch_number), desc='Training...')
-        best_ade = 100.0
-        best_epoch = 0
+        train_batches = self.get_train_batches(self.train_tensor)
+        self.best_ade = 100.0
+        self.best_epoch = 0
+        train_steps = 0
+        train_time = 0.0
         for batch in time_bar:
-            ADE = 0
-            ADE_move_average = tf.cast(0.0, dtype=tf.float32)    # 计算移动平均
-            loss_list = []
-            
-            obs_current, gt_current, train_sample_number = self.prepare_model_inputs_batch(self.train_tensor, self.args.batch_size)
+            step_start = time.time()
+            obs_current, gt_current, train_sample_number = next(train_batches)
 
             if train_sample_number < 20:
                 continue
 
-            with tf.GradientTape() as tape:
-                model_output_current = self.forward_train(obs_current)
-                loss_ADE, loss_list_current = self.loss(model_output_current, gt_current, obs=obs_current)
-                ADE_move_average = 0.7 * loss_ADE + 0.3 * ADE_move_average
-
-            ADE += loss_ADE
-            grads = tape.gradient(ADE_move_average, self.model.trainable_variables)
-            self.optimizer.apply_gradients(zip(grads, self.model.trainable_variables))
-
-            loss_list.append(loss_list_current)
-            loss_list = tf.reduce_mean(tf.stack(loss_list), axis=0).numpy()
+            _, loss_list_current = self.train_step(obs_current, gt_current)
+            train_time += time.time() - step_start
+            train_steps += 1
 
             epoch = (batch * self.args.batch_size) // train_length
 
-            if (epoch >= self.args.start_test_percent * self.args.epochs) and (epoch % self.args.test_step == 0):
-                model_output, loss_eval, _, _ = self.test_during_training(self.test_tensor, self.agents_test, self.test_index)
-                test_results.append(loss_eval)
-                test_loss_dict = create_loss_dict(loss_eval, self.loss_eval_namelist)
-                ade_current = loss_eval[0]
-                if ade_current <= best_ade:
-                    best_ade = ade_current
-                    best_epoch = epoch
-                    
-                    if self.args.save_best:
-                        self.model.save(os.path.join(self.args.log_dir, '{}_epoch{}.h5'.format(self.args.model_name, epoch)))
-                        np.savetxt(os.path.join(self.args.log_dir, 'best_ade_epoch.txt'), np.array([best_ade, best_epoch]))
+            if eval_scheduler.should_eval(epoch):
+                # 后台评估时使用当前权重的副本, 训练不会等待评估结束
+                eval_scheduler.submit(epoch, self.evaluate_weights, self.model.get_weights() if self.args.test_background else None)
 
-            
-            if epoch % 2 == 0:
-                train_loss_dict = create_loss_dict(loss_list, self.loss_namelist)
-                loss_dict = dict(train_loss_dict, **test_loss_dict) # 拼接字典
+            for eval_epoch, (loss_eval, weights), _ in eval_scheduler.results():
+                self.record_eval_results(eval_epoch, loss_eval, weights, test_results)
+
+            # 训练loss只在flush时同步到numpy并写入log
+            loss_dict = self.metrics_logger.add(self.loss_namelist, loss_list_current, epoch)
+            if loss_dict:
                 time_bar.set_postfix(loss_dict)
-                
-            with summary_writer.as_default():
-                for loss_name in loss_dict:
-                    value = loss_dict[loss_name]
-                    tf.summary.scalar(loss_name, value, step=epoch)
+
+        for eval_epoch, (loss_eval, weights), _ in eval_scheduler.results(wait=True):
+            self.record_eval_results(eval_epoch, loss_eval, weights, test_results)
+        self.metrics_logger.close()
+
+        if self.args.save_best:
+            self.checkpoint_writer.close()
+            print('Checkpoints: {}'.format(self.checkpoint_writer))
 
         print('Training done.')
+        print('Test during training: {}'.format(eval_scheduler))
+        print('{} training steps in {:.2f}s ({:.2f} steps/s, without tests) using the {} input pipeline.'.format(
+            train_steps, train_time, train_steps / np.maximum(train_time, 1e-8), self.args.input_pipeline,
+        ))
+        print('Logging metrics took {:.3f}s ({:.2f}% of training steps).'.format(
+            self.metrics_logger.log_time, 100 * self.metrics_logger.log_time / np.maximum(train_time, 1e-8),
+        ))
         print('Tensorboard training log file is saved at "{}"'.format(self.args.log_dir))
         print('To open this log file, please use "tensorboard --logdir {} --port 54393"'.format(self.args.log_dir))
         
@@ -299,6 +527,7 @@ class Base_Model():
             latest_results
         ))
         np.savetxt(os.path.join(self.args.log_dir, 'train_log.txt'), list2array(test_results))
+        self.test_loss = latest_results
 
         if self.args.save_model:
             self.model_save_path = os.path.join(self.args.log_dir, '{}.h5'.format(self.args.model_name))
@@ -343,6 +572,8 @@ class Base_Model():
             test_on_neighbors = True
 
         agents_batch, test_index = self.prepare_test_agents_batch(agents_batch, test_on_neighbors)
+        if self.patch_cache is not None:
+            print(self.patch_cache)
         
         # run test
         all_loss = []
@@ -374,6 +605,7 @@ class Base_Model():
             all_loss_batch.append(np.mean(np.stack(batch_loss), axis=0))
         
         average_loss = np.mean(np.stack(all_loss), axis=0)
+        self.test_loss = average_loss
         print('test_loss={}\nTest done.'.format(create_loss_dict(average_loss, ['ADE', 'FDE'])))
         # print(all_loss_batch)
 
@@ -533,27 +765,48 @@ class BGM(Base_Model):
         gt = tf.cast(tf.stack(gt), tf.float32)
         return [[input_trajs, input_maps], gt], agent_index
 
+    def prepare_model_inputs_arrays(self, input_samples:WindowSamples):
+        input_trajs = tf.cast(input_samples.obs, tf.float32)
+        input_maps = tf.cast(input_samples.maps, tf.float32)
+        gt = tf.cast(input_samples.gt, tf.float32)
+        return [[input_trajs, input_maps], gt], [i for i in range(len(gt))]
+
     def prepare_test_agents_batch(self, agents_batch:dict, test_on_neighbors=False):
         # create trajectory map for each batch
-        if not type(self.given_maps_when_test) == np.ndarray:
-            traj_maps = [TrajectoryMapManager(agents_batch[batch_index]) for batch_index in agents_batch]
+        batch_order = list(agents_batch)
+        if self.args.stream_map_window > 0 or self.args.stream_map_half_life > 0:
+            # one map for all batches, updated in the order of observation frames
+            batch_order = sorted(agents_batch)
+            stream_map = StreamingTrajectoryMap(
+                window=self.args.stream_map_window,
+                half_life=self.args.stream_map_half_life,
+                init_center=np.mean([agent.get_train_traj()[-1] for batch_index in agents_batch for agent in agents_batch[batch_index]], axis=0),
+            )
+            traj_maps = [stream_map for _ in batch_order]
+        elif not type(self.given_maps_when_test) == np.ndarray:
+            traj_maps = [create_trajectory_map(agents_batch[batch_index], self.args.map_backend) for batch_index in agents_batch]
         else:
             traj_maps = self.given_maps_when_test
             print('Using given maps')
 
         # write traj map and save batch order     
         test_index = dict()
-        for batch_index, traj_map in zip(agents_batch, traj_maps):
+        for batch_index, traj_map in zip(batch_order, traj_maps):
             total_count = 0
             if not batch_index in test_index:
                 test_index[batch_index] = []
+
+            if type(traj_map) == StreamingTrajectoryMap:
+                traj_map.stream_traj_maps(agents_batch[batch_index], threads=self.args.map_threads, cache=self.patch_cache, neighbors=test_on_neighbors)
+            else:
+                traj_map.write_traj_maps(agents_batch[batch_index], threads=self.args.map_threads, cache=self.patch_cache)
+            if test_on_neighbors and not type(traj_map) == StreamingTrajectoryMap:
+                traj_map.write_traj_maps_for_neighbors(agents_batch[batch_index], threads=self.args.map_threads, cache=self.patch_cache)
                 
             for agent_index, _ in enumerate(agents_batch[batch_index]):
-                agents_batch[batch_index][agent_index].write_traj_map(traj_map)
                 start_count = total_count
                 total_count += 1
                 if test_on_neighbors:
-                    agents_batch[batch_index][agent_index].write_traj_map_for_neighbors(traj_map)
                     nei_len = agents_batch[batch_index][agent_index].neighbor_number
                     total_count += nei_len
                 test_index[batch_index].append([i for i in range(start_count, total_count)])
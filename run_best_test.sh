@@ -11,4 +11,6 @@ python main.py --gpu 2 --load ./logs/20200905-202724NEW_500MRR3bgm2/NEW_500MRR3
 python main.py --gpu 2 --load ./logs/20200905-202726NEW_500MRR3bgm3/NEW_500MRR3 --draw_results 0 --sr_enable 0 && # 3
 python main.py --gpu 2 --load ./logs/20200905-202727NEW_500MRR3bgm4/NEW_500MRR3 --draw_results 0 --sr_enable 0 # 4
 
-# python main.py --load ./logs/20200915-203428TOY777bgm2/TOY777 --gpu 2  # toy exp
\ No newline at end of file
+# python main.py --load ./logs/20200915-203428TOY777bgm2/TOY777 --gpu 2  # toy exp
+# test all folds in one run:
+# python folds.py --gpu 2 --draw_results 0 --sr_enable 0 --test_sets 0 1 2 3 4 --fold_loads ./logs/20200905-202720NEW_500MRR3bgm0/NEW_500MRR3 ./logs/20200905-202722NEW_500MRR3bgm1/NEW_500MRR3 ./logs/20200905-202724NEW_500MRR3bgm2/NEW_500MRR3 ./logs/20200905-202726NEW_500MRR3bgm3/NEW_500MRR3 ./logs/20200905-202727NEW_500MRR3bgm4/NEW_500MRR3
@@ -6,47 +6,668 @@ LastEditTime: 2020-08-30 04:09:30
 Description: file content
 '''
 
+import itertools
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
 import numpy as np
 
+MAP_ID = itertools.count()  # 每个 TrajectoryMapManager 的编号, 用于 PatchCache
+
+
+def run_in_threads(function, args_list:list, threads):
+    """
+    Run `function(*args)` for each `args` in `args_list` with a pool of `threads` threads.
+    Only the large numpy gathers and arithmetic of each call release the GIL, so the speed-up depends
+    on the machine (see `benchmark.py --task map_threads`).
+    returns: a list of results in the order of `args_list`
+    """
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        return list(executor.map(lambda args: function(*args), args_list))
+
+
+class PatchCache():
+    """
+    Bounded LRU cache of trajectory map patches, keyed by (map id, center cell, angle, flip).
+    Windows that end their observation in the same map cell (and rotated copies with the same angle)
+    get the same patch, which is only sampled once.
+    """
+    def __init__(self, max_size):
+        """
+        `max_size`: max number of patches kept in the cache
+        """
+        self.max_size = max_size
+        self.patches = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.patches)
+
+    def __str__(self):
+        total = np.maximum(self.hits + self.misses, 1)
+        return 'Patch cache: {} hits, {} misses (hit rate {:.2f}%), {}/{} patches cached.'.format(
+            self.hits, self.misses, 100 * self.hits / total, len(self), self.max_size,
+        )
+
+    def get_patches(self, trajmap, centers, angles, flips, half_size=16, **kwargs):
+        """
+        `TrajectoryMapManager.extract_patches` through the cache.
+        Patches not in the cache are sampled together by `trajmap.read_patches(**kwargs)`.
+        """
+        flips = flips & (angles == 0)   # same as `get_patch`, rotated patches are not flipped
+        keys = np.column_stack([centers, np.round(angles * 1000), flips]).astype(np.int64)
+        unique_keys, inverse = np.unique(keys, axis=0, return_inverse=True)
+        inverse = inverse.reshape([-1])
+
+        patches = np.zeros([len(unique_keys), 2*half_size, 2*half_size])
+        missing = []
+        for index, key in enumerate(unique_keys.tolist()):
+            key = tuple([trajmap.map_id, half_size] + key)
+            if key in self.patches:
+                self.patches.move_to_end(key)
+                patches[index] = self.patches[key]
+            else:
+                missing.append(index)
+
+        self.hits += len(keys) - len(missing)
+        self.misses += len(missing)
+        if len(missing):
+            missing = np.array(missing)
+            patches[missing] = trajmap.read_patches(
+                unique_keys[missing, :2],
+                angles=unique_keys[missing, 2] / 1000,
+                flips=unique_keys[missing, 3].astype(bool),
+                half_size=half_size,
+                **kwargs
+            )
+            for index in missing[-self.max_size:]:
+                self.patches[tuple([trajmap.map_id, half_size] + unique_keys[index].tolist())] = patches[index].copy()
+            while len(self.patches) > self.max_size:
+                self.patches.popitem(last=False)
+
+        return patches[inverse]
+
+
 class TrajectoryMapManager():
     def __init__(self, agent_list:list):
+        """
+        `agent_list`: a list of `Agent_Part`, or their observed trajectories (`np.ndarray`, shape = [N, obs_frames, 2])
+        """
         self.agent_list = agent_list
         
         self.window_size_expand_meter = 5.0
         self.window_size_map = 4
 
         self.traj_map = 'null'
+        self.map_id = next(MAP_ID)
         self.traj = self.get_all_obs_traj()
         self.traj_map, self.W, self.b = self.initialize_traj_map(self.traj)
         self.add_to_map()
 
     def get_all_obs_traj(self):
-        traj = []
-        for agent in self.agent_list:
-            if agent.rotate == 0:
-                traj.append(agent.get_train_traj())
-        return np.stack(traj)
+        if type(self.agent_list) == np.ndarray:
+            return self.agent_list
+
+        agents = [agent for agent in self.agent_list if agent.rotate == 0]
+        traj = np.zeros([len(agents), agents[0].obs_length, 2])
+        for index, agent in enumerate(agents):
+            traj[index] = agent.get_train_traj()
+        return traj
 
     def initialize_traj_map(self, traj):
+        shape, W, b = self.get_map_extent(traj)
+        return np.zeros(shape), W, b
+
+    def get_map_extent(self, traj):
+        """
+        Shape of the map covering all `traj` (with `window_size_expand_meter` padding), and its `W`, `b`.
+        """
         x_max = np.max(traj[:, :, 0])
         x_min = np.min(traj[:, :, 0])
         y_max = np.max(traj[:, :, 1])
         y_min = np.min(traj[:, :, 1])
-        traj_map = np.zeros([
+        shape = (
             int((x_max - x_min + 2*self.window_size_expand_meter)*self.window_size_map) + 1,
             int((y_max - y_min + 2*self.window_size_expand_meter)*self.window_size_map) + 1,
-        ])
+        )
         
         W = np.array([self.window_size_map, self.window_size_map])
         b = np.array([x_min - self.window_size_expand_meter, y_min - self.window_size_expand_meter])
 
         self.mvalue = [x_max, x_min, y_max, y_min]
-        return traj_map, W, b
+        return shape, W, b
 
     def add_to_map(self, val=1):
-        for traj in self.traj:
-            map_pos = self.real2map(traj)
-            self.traj_map[map_pos.T[0], map_pos.T[1]] += val
+        """
+        Add all observed trajectories to the map in one pass. Every visit is counted,
+        including points of one trajectory that fall into the same cell.
+        """
+        map_pos = self.real2map(self.traj.reshape([-1, 2]))
+        cells = np.ravel_multi_index((map_pos.T[0], map_pos.T[1]), self.traj_map.shape)
+        self.traj_map += val * np.bincount(cells, minlength=self.traj_map.size).reshape(self.traj_map.shape)
 
     def real2map(self, traj:np.array):
         return ((traj - self.b) * self.W).astype(np.int)
+
+    @property
+    def map_shape(self):
+        return self.traj_map.shape
+
+    def memory_size(self):
+        """
+        Bytes used to store the map.
+        """
+        return self.traj_map.nbytes
+
+    def read_cells(self, rows, cols):
+        """
+        Map values at cells `(rows, cols)` (inside the map).
+        """
+        return self.traj_map[rows, cols]
+
+    def read_region(self, row_start, row_end, col_start, col_end):
+        return self.traj_map[row_start:row_end, col_start:col_end]
+
+    def get_inside_source(self, centers, half_size=16):
+        """
+        Source of patches whose crops `[4*half_size, 4*half_size]` around `centers` are inside the map.
+        returns: the flat source array, the top-left corner of each crop in it, and the width of source rows
+        """
+        width = self.map_shape[1]
+        corners = (centers[:, 0] - 2*half_size) * width + (centers[:, 1] - 2*half_size)
+        return self.traj_map.reshape([-1]), corners, width
+
+    def get_patch(self, center_pos, rotate=0, reverse=False, half_size=16):
+        """
+        Crop the map around `center_pos` (in map coordinate) and rotate (`rotate` in degree) or flip it.
+        returns: patch, shape = [2*half_size, 2*half_size]
+        """
+        map_shape = self.map_shape
+        original_map = cv2.resize(self.read_region(
+            np.maximum(center_pos[0]-2*half_size, 0), np.minimum(center_pos[0]+2*half_size, map_shape[0]), 
+            np.maximum(center_pos[1]-2*half_size, 0), np.minimum(center_pos[1]+2*half_size, map_shape[1]),
+        ), (4*half_size, 4*half_size))
+
+        final_map = original_map[half_size:3*half_size, half_size:3*half_size]
+        if reverse:
+            final_map = np.flip(final_map)
+
+        if rotate:
+            final_map = cv2.warpAffine(
+                original_map,
+                cv2.getRotationMatrix2D(
+                    (2*half_size, 2*half_size),
+                    rotate,
+                    1,
+                ),
+                (4*half_size, 4*half_size),
+            )
+            final_map = final_map[half_size:3*half_size, half_size:3*half_size]
+        return final_map
+
+    def extract_patches(self, centers, angles=None, flips=None, half_size=16, batch_size=4096, threads=0, cache=None):
+        """
+        Batch version of `get_patch`, i.e. crop (and rotate or flip) patches around all `centers` in one sampling pass.
+        Bilinear sampling follows `cv2.resize` and `cv2.warpAffine` (including its 1/32 pixel grid),
+        so results are the same as `get_patch` up to float rounding.
+        `centers`: centers in map coordinate, shape = [N, 2]
+        `angles`: rotate angles in degree, shape = [N]
+        `flips`: whether to flip each patch (ignored when it is rotated, same as `get_patch`), shape = [N]
+        `batch_size`: patches sampled at the same time near map borders, to limit memory use
+        `threads`: sample patches with a thread pool (split into chunks of `batch_size`), 0 or 1 for no threads
+        `cache`: a `PatchCache` to reuse patches sampled before, `None` for no cache
+        returns: patches, shape = [N, 2*half_size, 2*half_size]
+        """
+        centers = np.asarray(centers).reshape([-1, 2]).astype(np.int64)
+        number = len(centers)
+        angles = np.zeros(number) if angles is None else np.asarray(angles, dtype=np.float64).reshape([-1])
+        flips = np.zeros(number, dtype=bool) if flips is None else np.asarray(flips, dtype=bool).reshape([-1])
+
+        if cache is not None:
+            return cache.get_patches(self, centers, angles, flips, half_size=half_size, batch_size=batch_size, threads=threads)
+        return self.read_patches(centers, angles, flips, half_size, batch_size, threads)
+
+    def read_patches(self, centers, angles, flips, half_size=16, batch_size=4096, threads=0):
+        """
+        Sample patches of `extract_patches` from the stored map (without the cache), split into chunks
+        for the thread pool if `threads > 1`.
+        The thread pool and `PatchCache` call this method, but not `extract_patches`, so subclasses
+        that scale the patches in `extract_patches` are only scaled once.
+        """
+        number = len(centers)
+        if threads > 1 and number > batch_size // threads:
+            chunk_size = int(np.minimum(batch_size, np.ceil(number / threads)))
+            chunks = [slice(start, start + chunk_size) for start in range(0, number, chunk_size)]
+            return np.concatenate(run_in_threads(
+                self.sample_patch_batch,
+                [[centers[chunk], angles[chunk], flips[chunk], half_size, batch_size] for chunk in chunks],
+                threads,
+            ), axis=0)
+        return self.sample_patch_batch(centers, angles, flips, half_size, batch_size)
+
+    def sample_patch_batch(self, centers, angles, flips, half_size=16, batch_size=4096):
+        """
+        Sample patches of `extract_patches` in the current thread.
+        """
+        number = len(centers)
+        patches = np.zeros([number, 2*half_size, 2*half_size])
+
+        # the crop is not clipped by map borders, so `cv2.resize` keeps it unchanged
+        # and patches can be sampled from the map directly
+        inside = np.all((centers - 2*half_size >= 0) & (centers + 2*half_size <= self.map_shape), axis=-1)
+        inside_index = np.where(inside)[0]
+        flat_map, corner, width = self.get_inside_source(centers[inside_index], half_size)
+        for angle in np.unique(angles[inside_index]):
+            current = np.where(angles[inside_index] == angle)[0]
+            patches[inside_index[current]] = self.sample_patches(
+                flat_map, 
+                corner[current], 
+                self.get_sample_grid(angle, width, half_size),
+            )
+
+        # near map borders: resize the clipped crop first
+        border_index = np.where(~inside)[0]
+        for start in range(0, len(border_index), batch_size):
+            index = border_index[start:start+batch_size]
+            rotate = angles[index] != 0
+            patches[index[~rotate]] = self.resize_patches(centers[index[~rotate]], half_size, np.arange(half_size, 3*half_size))
+
+            rotate_index = index[rotate]
+            if not len(rotate_index):
+                continue
+            
+            flat_resized = self.resize_patches(centers[rotate_index], half_size).reshape([-1])
+            for angle in np.unique(angles[rotate_index]):
+                current = np.where(angles[rotate_index] == angle)[0]
+                patches[rotate_index[current]] = self.sample_patches(
+                    flat_resized, 
+                    current * (4*half_size)**2, 
+                    self.get_sample_grid(angle, 4*half_size, half_size),
+                )
+
+        flip_index = np.where(flips & (angles == 0))[0]
+        patches[flip_index] = patches[flip_index, ::-1, ::-1]
+        return patches
+
+    def get_sample_grid(self, angle, width, half_size=16):
+        """
+        Bilinear sampling grid (shared by all patches) of the patch rotated by `angle` (in degree), 
+        in a crop `[4*half_size, 4*half_size]` whose rows are `width` apart in memory.
+        Positions are the same as `cv2.warpAffine` (1/32 pixel grid, zero border) with
+        `cv2.getRotationMatrix2D((2*half_size, 2*half_size), angle, 1)`.
+        returns: `offset` of the top-left neighbor of each pixel (shape = [2*half_size, 2*half_size]), 
+            `weights` of its 4 neighbors (`None` if not rotated, shape = [4, 2*half_size, 2*half_size]),
+            and `shifts` of the 4 neighbors from the top-left one
+        """
+        size = 4 * half_size
+        shifts = [0, 1, width, width + 1]
+        grid = np.arange(half_size, 3*half_size)
+        col = grid[np.newaxis, :]
+        row = grid[:, np.newaxis]
+        if angle == 0:
+            return row * width + col, None, shifts
+
+        theta = angle * np.pi / 180
+        alpha = np.cos(theta)
+        beta = np.sin(theta)
+        center = 2*half_size
+        tx = (1-alpha) * center - beta * center
+        ty = beta * center + (1-alpha) * center
+        det = 1.0 / (alpha * alpha + beta * beta)     # `cv2.invertAffineTransform`
+        inv_m = [
+            [alpha * det, -beta * det, -alpha * det * tx + beta * det * ty],
+            [beta * det, alpha * det, -beta * det * tx - alpha * det * ty],
+        ]
+        src_col = (np.round(inv_m[0][0] * col * 1024) + np.round((inv_m[0][1] * row + inv_m[0][2]) * 1024) + 16).astype(np.int64) >> 5
+        src_row = (np.round(inv_m[1][0] * col * 1024) + np.round((inv_m[1][1] * row + inv_m[1][2]) * 1024) + 16).astype(np.int64) >> 5
+
+        row0 = src_row >> 5
+        col0 = src_col >> 5
+        wr = (src_row & 31) / 32
+        wc = (src_col & 31) / 32
+
+        weights = []
+        for dr, weight_r in [[0, 1 - wr], [1, wr]]:
+            for dc, weight_c in [[0, 1 - wc], [1, wc]]:
+                r = row0 + dr
+                c = col0 + dc
+                valid = (r >= 0) & (r < size) & (c >= 0) & (c < size)     # zero border
+                weights.append(weight_r * weight_c * valid)
+
+        offset = np.clip(row0, 0, size-1) * width + np.clip(col0, 0, size-1)
+        return offset, np.stack(weights), shifts
+
+    def sample_patches(self, flat_source, corners, sample_grid):
+        """
+        Sample patches from crops (starting at `corners` in the flat array `flat_source`) on a shared `sample_grid`.
+        """
+        offset, weights, shifts = sample_grid
+        index = corners.reshape([-1, 1, 1]) + offset
+        if weights is None:
+            return np.take(flat_source, index)
+
+        # neighbors outside the crop have zero weights
+        patches = 0.0
+        for shift, weight in zip(shifts, weights):
+            patches = patches + weight * np.take(flat_source[shift:], index, mode='clip')
+        return patches
+
+    def resize_patches(self, centers, half_size=16, positions=None):
+        """
+        Crops around `centers` (clipped by map borders) after `cv2.resize` (bilinear) to `[4*half_size, 4*half_size]`.
+        `positions`: only return these pixels (in both axes) of the resized crops, `None` for all pixels
+        returns: shape = [N, len(positions), len(positions)]
+        """
+        map_shape = self.map_shape
+        size = 4 * half_size
+        if positions is None:
+            positions = np.arange(size)
+
+        def resize_index(center, length):
+            start = np.maximum(center - 2*half_size, 0)[:, np.newaxis]
+            crop_length = np.minimum(center + 2*half_size, length)[:, np.newaxis] - start
+            pos = (positions + 0.5) * (crop_length / size) - 0.5
+            pos = np.clip(pos, 0, crop_length - 1)
+            index = np.floor(pos).astype(np.int64)
+            weight = pos - index
+            index_next = np.minimum(index + 1, crop_length - 1)
+            return start + index, start + index_next, weight
+
+        x0, x1, wx = resize_index(centers[:, 0], map_shape[0])
+        y0, y1, wy = resize_index(centers[:, 1], map_shape[1])
+        x0, x1, wx = x0[:, :, np.newaxis], x1[:, :, np.newaxis], wx[:, :, np.newaxis]
+        y0, y1, wy = y0[:, np.newaxis, :], y1[:, np.newaxis, :], wy[:, np.newaxis, :]
+        return (1 - wx) * ((1 - wy) * self.read_cells(x0, y0) + wy * self.read_cells(x0, y1)) \
+            + wx * ((1 - wy) * self.read_cells(x1, y0) + wy * self.read_cells(x1, y1))
+
+    def write_traj_maps(self, agent_list:list, threads=0, cache=None):
+        """
+        Batch version of `Agent_Part.write_traj_map` for all agents in `agent_list`.
+        `threads`, `cache`: see `extract_patches`
+        """
+        if not len(agent_list):
+            return
+
+        centers = np.stack([
+            agent.traj_original[agent.obs_length] if agent.rotate else agent.get_train_traj()[-1] for agent in agent_list
+        ])
+        patches = self.extract_patches(
+            self.real2map(centers),
+            angles=[agent.rotate for agent in agent_list],
+            flips=[agent.reverse for agent in agent_list],
+            threads=threads,
+            cache=cache,
+        )
+        for agent, patch in zip(agent_list, patches):
+            agent.traj_map = patch
+
+    def write_traj_maps_for_neighbors(self, agent_list:list, threads=0, cache=None):
+        """
+        Batch version of `Agent_Part.write_traj_map_for_neighbors` for all agents in `agent_list`.
+        `threads`, `cache`: see `extract_patches`
+        """
+        neighbor_number = [len(agent.get_neighbor_traj()) for agent in agent_list]
+        centers = [nei_traj[-1, :] for agent in agent_list for nei_traj in agent.get_neighbor_traj()]
+        patches = self.extract_patches(self.real2map(np.reshape(centers, [-1, 2])), threads=threads, cache=cache) if len(centers) else []
+
+        start = 0
+        for agent, number in zip(agent_list, neighbor_number):
+            agent.traj_map_neighbors = [patch for patch in patches[start:start+number]]
+            start += number
+
+
+def compact_dtype(values:np.ndarray):
+    """
+    Smallest unsigned integer dtype that holds `values` exactly (`float64` if they are not non-negative integers).
+    """
+    if not values.size:
+        return np.uint8
+    if np.min(values) < 0 or not np.all(np.mod(values, 1) == 0):
+        return np.float64
+    return np.min_scalar_type(int(np.max(values)))
+
+
+def create_trajectory_map(agent_list, backend='dense'):
+    """
+    Create the trajectory map of `agent_list` with the storage `backend`.
+    `backend`: 'dense' (`TrajectoryMapManager`) or 'tiled' (`TiledTrajectoryMap`)
+    """
+    if backend == 'tiled':
+        return TiledTrajectoryMap(agent_list)
+    return TrajectoryMapManager(agent_list)
+
+
+class TiledTrajectoryMap(TrajectoryMapManager):
+    """
+    Trajectory map that only stores tiles (`tile_size * tile_size` cells) visited by trajectories,
+    with counts in the smallest dtype that holds them (see `compact_dtype`).
+    It covers the same cells as `TrajectoryMapManager` and serves the same patches,
+    while its memory grows with the visited area instead of the bounding box of all trajectories.
+    """
+    def __init__(self, agent_list:list, tile_size=64):
+        self.tile_size = tile_size
+        super().__init__(agent_list)
+
+    def initialize_traj_map(self, traj):
+        self.shape, W, b = self.get_map_extent(traj)
+        tile_number = np.ceil(np.array(self.shape) / self.tile_size).astype(np.int64)
+        self.tile_index = np.zeros(tile_number, dtype=np.int32)     # 每个tile在 self.traj_map 中的位置, 0表示未访问 (全0的tile)
+        return np.zeros([1, self.tile_size, self.tile_size], dtype=np.uint8), W, b
+
+    @property
+    def map_shape(self):
+        return self.shape
+
+    def memory_size(self):
+        return self.traj_map.nbytes + self.tile_index.nbytes
+
+    def add_to_map(self, val=1):
+        size = self.tile_size
+        map_pos = self.real2map(self.traj.reshape([-1, 2]))
+        tiles = np.ravel_multi_index(((map_pos // size).T[0], (map_pos // size).T[1]), self.tile_index.shape)
+
+        flat_index = self.tile_index.reshape([-1])
+        new_tiles = np.unique(tiles[flat_index[tiles] == 0])
+        flat_index[new_tiles] = np.arange(len(new_tiles)) + len(self.traj_map)
+        tile_number = len(self.traj_map) + len(new_tiles)
+
+        local = map_pos % size
+        cells, counts = np.unique((flat_index[tiles] * size + local[:, 0]) * size + local[:, 1], return_counts=True)
+        values = self.traj_map.reshape([-1])[np.minimum(cells, self.traj_map.size - 1)] * (cells < self.traj_map.size) + val * counts
+
+        traj_map = np.zeros([tile_number, size, size], dtype=np.promote_types(self.traj_map.dtype, compact_dtype(values)))
+        traj_map[:len(self.traj_map)] = self.traj_map
+        traj_map.reshape([-1])[cells] = values
+        self.traj_map = traj_map
+
+    def read_cells(self, rows, cols):
+        """
+        Map values (in the stored dtype) at cells `(rows, cols)`.
+        """
+        size = self.tile_size
+        return self.traj_map[self.tile_index[rows // size, cols // size], rows % size, cols % size]
+
+    def read_region(self, row_start, row_end, col_start, col_end):
+        return self.read_cells(
+            np.arange(row_start, row_end)[:, np.newaxis], 
+            np.arange(col_start, col_end)[np.newaxis, :],
+        ).astype(np.float64)
+
+    def get_inside_source(self, centers, half_size=16):
+        # gather the `k * k` tiles that cover each crop into a block, crops are then read from these blocks
+        size = self.tile_size
+        k = (4*half_size - 1) // size + 2
+        start = centers - 2*half_size
+        first = start // size
+        tiles = self.tile_index[
+            np.minimum(first[:, 0, np.newaxis, np.newaxis] + np.arange(k)[np.newaxis, :, np.newaxis], self.tile_index.shape[0] - 1),
+            np.minimum(first[:, 1, np.newaxis, np.newaxis] + np.arange(k)[np.newaxis, np.newaxis, :], self.tile_index.shape[1] - 1),
+        ]   # tiles outside the map are replaced by the last ones, crops never read them
+        blocks = self.traj_map[tiles].transpose([0, 1, 3, 2, 4])
+        width = k * size
+        local = start % size
+        corners = np.arange(len(centers)) * width**2 + local[:, 0] * width + local[:, 1]
+        return blocks.reshape([-1]), corners, width
+
+    def sample_patch_batch(self, centers, angles, flips, half_size=16, batch_size=4096):
+        # crops are gathered for each batch, so sample at most `batch_size` patches at a time
+        return np.concatenate([super(TiledTrajectoryMap, self).sample_patch_batch(
+            centers[start:start+batch_size],
+            angles[start:start+batch_size],
+            flips[start:start+batch_size],
+            half_size, batch_size,
+        ) for start in range(0, max(len(centers), 1), batch_size)], axis=0)
+
+
+class StreamingTrajectoryMap(TrajectoryMapManager):
+    """
+    Trajectory map updated incrementally for streaming use.
+    Observed trajectories are added as they arrive (`add`), contributions older than `window` frames
+    are evicted and/or all contributions decay with a half life of `half_life` frames (`advance`),
+    and the map grows when trajectories leave its current extent.
+    Updates cost O(new points) (amortized when the map grows), patches are read as `TrajectoryMapManager`.
+    """
+    def __init__(self, window=0, half_life=0, init_center=[0.0, 0.0], init_size_meter=20.0):
+        """
+        `window`: frames that a trajectory stays in the map, 0 for no eviction
+        `half_life`: frames that the weight of a trajectory halves, 0 for no decay
+        `init_center`, `init_size_meter`: initial extent of the map (in meters)
+        """
+        self.window_size_expand_meter = 5.0
+        self.window_size_map = 4
+        self.window = window
+        self.half_life = half_life
+
+        self.W = np.array([self.window_size_map, self.window_size_map])
+        self.origin = np.array(init_center, dtype=np.float64) - init_size_meter / 2  # 全局网格坐标的原点, 不会改变
+        self.cell_offset = np.zeros([2], dtype=np.int64)    # traj_map[0, 0] 的全局网格坐标
+        self.b = self.origin
+        self.traj_map = np.zeros([int(init_size_meter * self.window_size_map) + 1] * 2)
+        self.map_id = next(MAP_ID)
+
+        self.history = deque()  # [frame, global cells, stored weight] of each added frame
+        self.current_frame = -np.inf
+        self.reference_frame = None     # stored values are `actual value * 2^((reference_frame - current_frame) / half_life)`
+
+    def real2map(self, traj:np.array):
+        return self.real2cell(traj) - self.cell_offset
+
+    def real2cell(self, traj:np.array):
+        """
+        Global cell coordinates (do not change when the map grows).
+        """
+        return np.floor((np.asarray(traj) - self.origin) * self.W).astype(np.int64)
+
+    def add(self, traj, frames, val=1):
+        """
+        Add observed trajectories `traj` (shape = [N, obs_frames, 2]) observed at `frames` (a frame or shape = [N]).
+        Frames should not be earlier than the current frame minus `window`.
+        """
+        traj = np.asarray(traj, dtype=np.float64).reshape([-1, np.shape(traj)[-2], 2])
+        frames = np.asarray(frames).reshape([-1]) * np.ones(len(traj), dtype=np.int64)
+        if not len(traj):
+            return
+
+        self.advance(np.max(frames))
+        cells = self.real2cell(traj)    # shape = [N, obs_frames, 2]
+        self.extend(cells.reshape([-1, 2]))
+
+        for frame in np.unique(frames):
+            frame_cells = cells[frames == frame].reshape([-1, 2])
+            weight = val * self.stored_weight(frame)
+            self.history.append([frame, frame_cells, weight])
+            self.update_cells(frame_cells, weight)
+        
+        self.map_id = next(MAP_ID)  # patches cached before are no longer valid
+
+    def advance(self, frame):
+        """
+        Move the current time to `frame`: evict trajectories older than `window` frames and apply the decay.
+        """
+        if frame <= self.current_frame:
+            return
+        
+        self.current_frame = frame
+        if self.window > 0:
+            while len(self.history) and self.history[0][0] <= frame - self.window:
+                _, frame_cells, weight = self.history.popleft()
+                self.update_cells(frame_cells, -weight)
+
+        if self.half_life > 0:
+            if self.reference_frame is None:
+                self.reference_frame = frame
+            elif (frame - self.reference_frame) / self.half_life > 256:
+                # rescale stored values to the new reference frame to avoid overflow
+                scale = 2.0 ** (-(frame - self.reference_frame) / self.half_life)
+                self.traj_map *= scale
+                for item in self.history:
+                    item[2] *= scale
+                self.reference_frame = frame
+
+        self.map_id = next(MAP_ID)
+
+    def stored_weight(self, frame):
+        if self.half_life <= 0 or self.reference_frame is None:
+            return 1.0
+        return 2.0 ** ((frame - self.reference_frame) / self.half_life)
+
+    def read_scale(self):
+        """
+        Scale from stored values to the (decayed) values at the current frame.
+        """
+        return 1.0 / self.stored_weight(self.current_frame) if self.current_frame > -np.inf else 1.0
+
+    def update_cells(self, cells, weight):
+        map_pos = cells - self.cell_offset
+        flat_cells, counts = np.unique(np.ravel_multi_index((map_pos.T[0], map_pos.T[1]), self.traj_map.shape), return_counts=True)
+        flat_map = self.traj_map.reshape([-1])
+        flat_map[flat_cells] = np.maximum(flat_map[flat_cells] + weight * counts, 0.0)
+
+    def extend(self, cells):
+        """
+        Grow the map (with `window_size_expand_meter` margin, at least doubling each grown side) to cover global `cells`.
+        """
+        margin = int(self.window_size_expand_meter * self.window_size_map)
+        map_pos = cells - self.cell_offset
+        low = np.minimum(np.min(map_pos, axis=0) - margin, 0)
+        high = np.maximum(np.max(map_pos, axis=0) + margin + 1, self.traj_map.shape)
+        if np.all(low == 0) and np.all(high == self.traj_map.shape):
+            return
+        
+        shape = np.array(self.traj_map.shape)
+        low = np.where(low < 0, np.minimum(low, -shape), 0)
+        high = np.where(high > shape, np.maximum(high, 2 * shape), shape)
+
+        traj_map = np.zeros(high - low)
+        traj_map[-low[0]:-low[0]+shape[0], -low[1]:-low[1]+shape[1]] = self.traj_map
+        self.traj_map = traj_map
+        self.cell_offset = self.cell_offset + low
+        self.b = self.origin + self.cell_offset / self.W
+
+    def get_patch(self, center_pos, rotate=0, reverse=False, half_size=16):
+        return super().get_patch(center_pos, rotate, reverse, half_size) * self.read_scale()
+
+    def extract_patches(self, centers, angles=None, flips=None, half_size=16, batch_size=4096, threads=0, cache=None):
+        # `PatchCache` and the thread pool read unscaled patches (`read_patches`), so they are scaled only here
+        return super().extract_patches(centers, angles, flips, half_size, batch_size, threads, cache) * self.read_scale()
+
+    def stream_traj_maps(self, agent_list:list, threads=0, cache=None, neighbors=False):
+        """
+        Replay `agent_list` in the order of their observation frames:
+        observed trajectories of agents observed at each frame are added to the map,
+        and then trajectory maps of these agents (and their neighbors if `neighbors`) are written from the current map.
+        `threads`, `cache`: see `extract_patches`
+        """
+        obs_frames = np.array([agent.obs_frame for agent in agent_list])
+        for frame in np.unique(obs_frames):
+            agents = [agent_list[index] for index in np.where(obs_frames == frame)[0]]
+            observed = [agent.get_train_traj() for agent in agents if agent.rotate == 0]
+            self.advance(frame)     # apply the decay even if no trajectory is added at this frame
+            if len(observed):
+                self.add(np.stack(observed), frame)
+
+            self.write_traj_maps(agents, threads=threads, cache=cache)
+            if neighbors:
+                self.write_traj_maps_for_neighbors(agents, threads=threads, cache=cache)
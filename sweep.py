@@ -0,0 +1,202 @@
+'''
+@Description: hyperparameter sweeps sharing sampled data between trials
+'''
+import copy
+import itertools
+import json
+import os
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+import numpy as np
+from tensorflow import keras
+
+from folds import run_fold, set_threads
+from helpmethods import dir_check
+from main import get_parser, set_log_dir
+from PrepareTrainData import DataManager
+
+TRAIN_INFO = dict()     # {data key: train_info} shared by all trials in a process
+MAP_SIZE = 32   # trajectory maps are sampled as 32x32 patches (`half_size=16` in `TrajectoryMapManager.extract_patches`)
+
+
+def get_sweep_parser():
+    parser = get_parser()
+    parser.description = 'hyperparameter sweep'
+    parser.add_argument('--sweep_spec', type=str, default='{}')
+    # 搜索空间, json字符串或json文件路径, 例如 '{"lr": [1e-3, 3e-4], "batch_size": [500, 2000]}';
+    # 'random' 模式下也可以使用 {"low": 1e-4, "high": 1e-2, "log": true} 表示连续的取值范围
+    parser.add_argument('--sweep_mode', type=str, default='grid')
+    # 'grid': 所有取值的组合
+    # 'random': 随机取样 sweep_trials 组取值
+    parser.add_argument('--sweep_trials', type=int, default=10)     # 'random' 模式下的trial数量
+    parser.add_argument('--sweep_seed', type=int, default=10)
+    parser.add_argument('--sweep_workers', type=int, default=1)     # 并行运行trial的进程数, 0表示在当前进程中依次运行
+    parser.add_argument('--sweep_cores', type=int, default=0)     # 所有trial共用的CPU核数, 平均分配给每个进程, 0表示所有核
+    return parser
+
+
+def load_spec(spec):
+    if os.path.exists(spec):
+        with open(spec, 'r') as f:
+            return json.load(f)
+    return json.loads(spec)
+
+
+def get_trials(parser, spec:dict, mode='grid', trials=10, seed=10):
+    """
+    Args values (`[{name: value}]`) of each trial from the search `spec` (`{name: [values] or {low, high, log}}`).
+    Values are converted with the types in `parser`.
+    `gridmapsize` can not be searched, since sampled trajectory maps are always `MAP_SIZE`.
+    """
+    actions = {action.dest: action for action in parser._actions}
+    for name in spec:
+        if not name in actions:
+            raise ValueError('`{}` in the sweep spec is not an arg of `main.py`.'.format(name))
+
+    if 'gridmapsize' in spec and not spec['gridmapsize'] in [[MAP_SIZE], MAP_SIZE]:
+        raise ValueError('Trajectory maps are sampled as {0}x{0} patches, so `gridmapsize` in the sweep spec can only be {0}.'.format(MAP_SIZE))
+
+    def convert(name, value):
+        action = actions[name]
+        if action.nargs == '+':
+            return [action.type(item) for item in (value if type(value) == list else [value])]
+        return action.type(value) if action.type is not None else value
+
+    if mode == 'grid':
+        names = list(spec)
+        for name in names:
+            if type(spec[name]) == dict:
+                raise ValueError('Give a list of values of `{}` in the sweep spec when using grid search.'.format(name))
+        return [{name: convert(name, value) for name, value in zip(names, values)}
+                for values in itertools.product(*[spec[name] for name in names])]
+
+    elif mode == 'random':
+        random_state = np.random.RandomState(seed)
+        trial_list = []
+        for _ in range(trials):
+            values = dict()
+            for name, space in spec.items():
+                if type(space) == dict and space.get('log', False):
+                    value = np.exp(random_state.uniform(np.log(space['low']), np.log(space['high'])))
+                elif type(space) == dict:
+                    value = random_state.uniform(space['low'], space['high'])
+                else:
+                    value = space[random_state.randint(len(space))]
+                values[name] = convert(name, value.item() if type(value) == np.float64 else value)
+            trial_list.append(values)
+        return trial_list
+
+    raise ValueError('Unknown sweep mode `{}`.'.format(mode))
+
+
+def get_data_key(args):
+    return json.dumps({name: getattr(args, name) for name in DataManager.data_args})
+
+
+def get_trial_args(args, index, values:dict):
+    """
+    Args of the trial `index`, with its own `model_name` and `log_dir` (`{log_dir}/trial{index}` if `--log_dir` is given).
+    """
+    trial_args = copy.deepcopy(args)
+    for name, value in values.items():
+        setattr(trial_args, name, value)
+    trial_args.model_name = '{}_trial{}'.format(args.model_name, index)
+    if not args.log_dir == 'null':
+        os.makedirs(args.log_dir, exist_ok=True)    # `dir_check` only creates the last level
+        trial_args.log_dir = os.path.join(args.log_dir, 'trial{}'.format(index))
+    return set_log_dir(trial_args)
+
+
+def prepare_data(trial_args:list):
+    """
+    Sample data once for each group of trials with the same `DataManager.data_args`.
+    returns: `{data key: train_info}`
+    """
+    train_info = dict()
+    for args in trial_args:
+        data_key = get_data_key(args)
+        if not data_key in train_info:
+            print('Prepare data for {}...'.format(data_key))
+            data_args = copy.deepcopy(args)
+            data_args.log_dir = args.save_base_dir
+            train_info[data_key] = DataManager(data_args).train_info
+    return train_info
+
+
+def init_worker(args, threads, train_info):
+    set_threads(args, threads)
+    TRAIN_INFO.update(train_info)
+
+
+def run_trial(index, args):
+    """
+    Train the model of one trial on the shared data.
+    returns: `(index, [ADE, FDE], seconds, error)`
+    """
+    time_start = time.time()
+    try:
+        _, test_loss, _ = run_fold(args, TRAIN_INFO[get_data_key(args)])
+        error = ''
+    except Exception as e:
+        test_loss = np.array([np.nan, np.nan])
+        error = '{}: {}'.format(type(e).__name__, e)
+        keras.backend.clear_session()
+        print('Trial {} failed with {}'.format(index, error))
+    return index, test_loss, time.time() - time_start, error
+
+
+def main():
+    parser = get_sweep_parser()
+    args = parser.parse_args()
+    dir_check('./results')
+
+    spec = load_spec(args.sweep_spec)
+    trials = get_trials(parser, spec, args.sweep_mode, args.sweep_trials, args.sweep_seed)
+    trial_args = [get_trial_args(args, index, values) for index, values in enumerate(trials)]
+    train_info = prepare_data(trial_args)
+    print('{} trials on {} sampled datasets.'.format(len(trials), len(train_info)))
+
+    cores = args.sweep_cores if args.sweep_cores > 0 else os.cpu_count()
+    workers = min(args.sweep_workers, cores, len(trials))
+    threads = max(cores // max(workers, 1), 1)     # 每个进程使用的线程数
+
+    time_start = time.time()
+    if workers > 0:
+        print('Run trials in {} processes with {} threads each.'.format(workers, threads))
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=get_context('spawn'),
+            initializer=init_worker,
+            initargs=(args, threads, train_info),
+        ) as executor:
+            results = list(executor.map(run_trial, range(len(trials)), trial_args))
+    else:
+        init_worker(args, threads, train_info)
+        results = [run_trial(index, current_args) for index, current_args in enumerate(trial_args)]
+
+    # results table
+    table_path = './results/sweep-{}.csv'.format(args.model_name)
+    names = list(spec)
+    with open(table_path, 'w') as f:
+        f.write(','.join(['trial'] + names + ['ADE', 'FDE', 'time', 'log_dir', 'error']) + '\n')
+        for index, test_loss, seconds, error in results:
+            values = [json.dumps(trials[index][name]).replace(',', ' ') for name in names]
+            f.write(','.join([str(index)] + values + [
+                '{:.4f}'.format(test_loss[0]), '{:.4f}'.format(test_loss[1]), '{:.1f}'.format(seconds),
+                trial_args[index].log_dir, error.replace(',', ' ').replace('\n', ' '),
+            ]) + '\n')
+
+    print('-----------------Sweep-----------------')
+    print('\t'.join(['trial'] + names + ['ADE', 'FDE', 'time(s)']))
+    for index, test_loss, seconds, _ in sorted(results, key=lambda item: np.nan_to_num(item[1][0], nan=np.inf)):
+        print('\t'.join([str(index)] + [str(trials[index][name]) for name in names] + [
+            '{:.4f}'.format(test_loss[0]), '{:.4f}'.format(test_loss[1]), '{:.1f}'.format(seconds),
+        ]))
+    print('{} trials done in {:.1f}s, results are saved at "{}".'.format(len(trials), time.time() - time_start, table_path))
+
+
+if __name__ == "__main__":
+    main()
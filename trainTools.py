@@ -0,0 +1,281 @@
+'''
+@Description: tools used in the training loop
+'''
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import tensorflow as tf
+
+
+class EvalScheduler():
+    """
+    Decide when to evaluate the model during training, and run evaluations.
+
+    The model is evaluated once in each interval of `every_epochs` epochs that starts after `start_epoch`
+    (on the first batch that reaches it, even if a batch skips the interval's first epoch),
+    or once every `every_seconds` seconds of training if `every_seconds > 0`.
+    When `background`, evaluations run in a background thread on a snapshot of the weights
+    (see `submit`), so training continues while evaluating.
+    """
+    def __init__(self, every_epochs=1, every_seconds=0, start_epoch=0, background=False):
+        self.every_epochs = max(int(every_epochs), 1)
+        self.every_seconds = every_seconds
+        self.start_epoch = start_epoch
+        self.background = background
+
+        self.last_interval = None   # index of the latest evaluated interval (`epoch // every_epochs`)
+        self.last_time = time.time()
+        self.eval_number = 0
+        self.eval_time = 0.0    # 评估所用的总时间 (秒)
+        self.executor = ThreadPoolExecutor(max_workers=1) if background else None
+        self.jobs = []
+
+    def __str__(self):
+        return '{} evaluations in {:.2f}s ({:.2f}s each, {}).'.format(
+            self.eval_number,
+            self.eval_time,
+            self.eval_time / max(self.eval_number, 1),
+            'in background' if self.background else 'blocking training',
+        )
+
+    def should_eval(self, epoch):
+        """
+        Whether to evaluate at the current `epoch` (called on each batch), i.e. the first batch of a new interval.
+        With `every_seconds`, it may evaluate several times in one epoch when an epoch is longer than the interval.
+        """
+        if epoch < self.start_epoch:
+            return False
+
+        if self.every_seconds > 0:
+            due = (time.time() - self.last_time >= self.every_seconds)
+        else:
+            interval = epoch // self.every_epochs
+            due = (self.last_interval is None or interval > self.last_interval) and interval * self.every_epochs >= self.start_epoch
+            if due:
+                self.last_interval = interval
+
+        if due:
+            self.last_time = time.time()
+        return due
+
+    def submit(self, epoch, function, *args):
+        """
+        Run `function(*args)` for the evaluation at `epoch`.
+        Pass a snapshot (e.g. `model.get_weights()`) in `args` when evaluating in background.
+        Finished evaluations are returned by `results`.
+        """
+        def timed_eval():
+            time_start = time.time()
+            result = function(*args)
+            return epoch, result, time.time() - time_start
+
+        if self.executor is None:
+            self.jobs.append(timed_eval())
+        else:
+            self.jobs.append(self.executor.submit(timed_eval))
+
+    def results(self, wait=False):
+        """
+        Finished evaluations `(epoch, result, seconds)` since the last call, in the order they were submitted.
+        `wait`: wait for all submitted evaluations (e.g. at the end of training)
+        """
+        finished = []
+        while len(self.jobs):
+            job = self.jobs[0]
+            if type(job) == tuple:
+                finished.append(job)
+            elif wait or job.done():
+                finished.append(job.result())
+            else:
+                break
+            self.jobs.pop(0)
+
+        for _, _, seconds in finished:
+            self.eval_number += 1
+            self.eval_time += seconds
+
+        if wait and self.executor is not None:
+            self.executor.shutdown()
+        return finished
+
+
+class CheckpointWriter():
+    """
+    Write checkpoints (`{model_name}_epoch{epoch}.h5`) in a background thread.
+
+    `save` only keeps a snapshot of the weights, which are then set to `model` (a copy of the trained model
+    used only by the writer) and saved off the training thread.
+    Only the `keep_best` checkpoints with the lowest ADE and the `keep_latest` latest ones are kept (0 to keep all
+    best checkpoints / no latest ones), and `best_ade_epoch.txt` is replaced atomically after the best checkpoint
+    is completely written, so readers never see a half-written file.
+    """
+    def __init__(self, model, log_dir, model_name, keep_best=3, keep_latest=0):
+        self.model = model
+        self.log_dir = log_dir
+        self.model_name = model_name
+        self.keep_best = keep_best
+        self.keep_latest = keep_latest
+
+        self.best_ade = np.inf
+        self.best_epoch = None  # checkpoint in `best_ade_epoch.txt`
+        self.checkpoints = []   # [epoch, ade] of checkpoints on disk, in the order they were written
+        self.write_number = 0
+        self.write_time = 0.0
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.jobs = []
+
+    def __str__(self):
+        return '{} checkpoints written in {:.2f}s (in background), {} kept.'.format(
+            self.write_number, self.write_time, len(self.checkpoints),
+        )
+
+    def get_path(self, epoch):
+        return os.path.join(self.log_dir, '{}_epoch{}.h5'.format(self.model_name, epoch))
+
+    def save(self, epoch, ade, weights):
+        """
+        Save `weights` (a snapshot, e.g. `model.get_weights()`) evaluated at `epoch` with `ade`.
+        Checkpoints that are not the best so far are only saved when `keep_latest > 0`.
+        returns: whether the checkpoint is saved
+        """
+        best = (ade <= self.best_ade)
+        if not (best or self.keep_latest > 0):
+            return False
+
+        if best:
+            self.best_ade = ade
+        self.jobs.append(self.executor.submit(self.write, epoch, ade, weights, best))
+        self.jobs = [job for job in self.jobs if not job.done() or job.exception()]
+        return True
+
+    def write(self, epoch, ade, weights, best):
+        time_start = time.time()
+        path = self.get_path(epoch)
+        temp_path = path.replace('.h5', '.tmp.h5')
+        self.model.set_weights(weights)
+        self.model.save(temp_path)
+        os.replace(temp_path, path)
+
+        if best:
+            temp_path = os.path.join(self.log_dir, 'best_ade_epoch.tmp.txt')
+            np.savetxt(temp_path, np.array([ade, epoch]))
+            os.replace(temp_path, os.path.join(self.log_dir, 'best_ade_epoch.txt'))
+            self.best_epoch = epoch
+
+        self.checkpoints = [item for item in self.checkpoints if not item[0] == epoch] + [[epoch, ade]]
+        self.remove_old_checkpoints()
+        self.write_number += 1
+        self.write_time += time.time() - time_start
+
+    def remove_old_checkpoints(self):
+        keep = set(epoch for epoch, _ in self.checkpoints[-self.keep_latest:]) if self.keep_latest > 0 else set()
+        best = sorted(self.checkpoints, key=lambda item: item[1])
+        keep.update(epoch for epoch, _ in (best[:self.keep_best] if self.keep_best > 0 else best))
+        keep.add(self.best_epoch)     # `best_ade_epoch.txt` always points to an existing checkpoint
+
+        for epoch, _ in self.checkpoints:
+            if not epoch in keep and os.path.exists(self.get_path(epoch)):
+                os.remove(self.get_path(epoch))
+        self.checkpoints = [item for item in self.checkpoints if item[0] in keep]
+
+    def close(self):
+        """
+        Wait for all checkpoints to be written.
+        """
+        self.executor.shutdown(wait=True)
+        for job in self.jobs:
+            job.result()    # raise errors of the writer thread
+
+
+class MetricsLogger():
+    """
+    Buffered logging of training metrics, and logging of evaluation metrics.
+
+    `add` only accumulates metric tensors of training steps (on device, without syncing them to numpy).
+    Every `flush_every` training steps (and on `flush`), means of the accumulated metrics are fetched at once.
+    Evaluation metrics (already on host) are written by `write` right away at their own epoch.
+    Metrics are written to TensorBoard summaries and to `metrics.csv` (`step,epoch,name,value` rows)
+    or `metrics.jsonl` (one line per write) if `log_format` is 'csv' or 'jsonl'.
+    """
+    def __init__(self, log_dir, flush_every=50, log_format='none'):
+        self.flush_every = max(int(flush_every), 1)
+        self.summary_writer = tf.summary.create_file_writer(log_dir)
+        self.log_path = None
+        if log_format in ['csv', 'jsonl']:
+            self.log_path = os.path.join(log_dir, 'metrics.{}'.format(log_format))
+            with open(self.log_path, 'w') as f:
+                f.write('step,epoch,name,value\n' if log_format == 'csv' else '')
+
+        self.sums = dict()      # {names: [sum of values, count]}
+        self.latest = dict()    # metrics of the latest flush
+        self.step = 0
+        self.epoch = 0
+        self.log_time = 0.0
+
+    def add(self, names:list, values, epoch):
+        """
+        Accumulate metrics `values` (a tensor or array, shape = [len(names)]) named `names` of a training step at `epoch`.
+        returns: metrics of the latest flush if they are flushed by this call, otherwise `None`
+        """
+        time_start = time.time()
+        key = tuple(names)
+        if not tf.is_tensor(values):
+            values = np.asarray(values, dtype=np.float64)
+        if key in self.sums:
+            self.sums[key][0] = self.sums[key][0] + values
+            self.sums[key][1] += 1
+        else:
+            self.sums[key] = [values, 1]
+        self.epoch = epoch
+
+        flushed = None
+        self.step += 1
+        if self.step % self.flush_every == 0:
+            flushed = self.flush()
+        self.log_time += time.time() - time_start
+        return flushed
+
+    def flush(self):
+        """
+        Write the means of all accumulated metrics.
+        returns: metrics of the latest flush (`dict`)
+        """
+        if not len(self.sums):
+            return self.latest
+
+        means = dict()
+        for names, (values, count) in self.sums.items():
+            means.update(zip(names, np.reshape(np.asarray(values) / count, [-1]).tolist()))
+        self.sums = dict()
+        self.write_metrics(means, self.epoch)
+        return self.latest
+
+    def write(self, names:list, values, epoch):
+        """
+        Write metrics `values` (shape = [len(names)]) named `names` at `epoch` right away, e.g. results of a test.
+        """
+        time_start = time.time()
+        self.write_metrics(dict(zip(names, np.reshape(np.asarray(values, dtype=np.float64), [-1]).tolist())), epoch)
+        self.log_time += time.time() - time_start
+
+    def write_metrics(self, metrics:dict, epoch):
+        self.latest.update(metrics)
+        with self.summary_writer.as_default():
+            for name in metrics:
+                tf.summary.scalar(name, metrics[name], step=epoch)
+
+        if self.log_path is not None:
+            with open(self.log_path, 'a') as f:
+                if self.log_path.endswith('.csv'):
+                    f.writelines('{},{},{},{}\n'.format(self.step, epoch, name, metrics[name]) for name in metrics)
+                else:
+                    f.write(json.dumps(dict(step=self.step, epoch=int(epoch), **metrics)) + '\n')
+
+    def close(self):
+        time_start = time.time()
+        self.flush()
+        self.summary_writer.flush()
+        self.log_time += time.time() - time_start
@@ -13,4 +13,9 @@ python main.py --gpu 1 --train_type all --model bgm --reverse 1 --rotate 3 --bat
 python main.py --gpu 1 --train_type all --model bgm --reverse 1 --rotate 3 --batch_size 20000 --epochs 500 --model_name NEW_500MRR3 --train_percent 0.0 --test_set 2 && 
 python main.py --gpu 1 --train_type all --model bgm --reverse 1 --rotate 3 --batch_size 20000 --epochs 500 --model_name NEW_500MRR3 --train_percent 0.0 --test_set 3 && 
 python main.py --gpu 1 --train_type all --model bgm --reverse 1 --rotate 3 --batch_size 20000 --epochs 500 --model_name NEW_500MRR3 --train_percent 0.0 --test_set 4 # && 
-# python get_all_result.py --model_name NEW_500MRR3
\ No newline at end of file
+# python get_all_result.py --model_name NEW_500MRR3
+# all folds in one run, datasets are loaded and sampled only once:
+# python folds.py --gpu 1 --train_type all --model bgm --reverse 1 --rotate 3 --batch_size 20000 --epochs 500 --model_name NEW_500MRR3 --train_percent 0.0 --test_sets 0 1 2 3 4
+
+# hyperparameter sweep, trials with the same data args share the sampled data:
+# python sweep.py --gpu 1 --train_type all --model bgm --epochs 500 --model_name SWEEP --test_set 2 --sweep_spec '{"lr": [1e-3, 3e-4], "batch_size": [5000, 20000], "rotate": [0, 3]}' --sweep_workers 2